@@ -0,0 +1,5 @@
+""" Carafe """
+import time
+
+# taken before the rest of carafe is imported so startup can be reported
+STARTED = time.perf_counter()
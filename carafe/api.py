@@ -0,0 +1,222 @@
+""" Carafe JSON API """
+
+from flask import Blueprint, abort, jsonify, request
+from sqlalchemy.orm import joinedload, undefer_group
+from werkzeug.exceptions import HTTPException
+
+from carafe import constants
+from carafe.database.model import Board, Post, Comment
+from carafe.database.pagination import paginate
+from carafe.database.routing import use_replica
+from carafe.extensions.response import conditional
+
+API = Blueprint('api', __name__, url_prefix='/api/v1')
+API.before_request(use_replica)
+
+
+def _date(value):
+    """
+    serializes an optional datetime
+    """
+    return value.isoformat() if value else None
+
+
+BOARD_FIELDS = {
+    'bid': lambda b: b.bid,
+    'name': lambda b: b.name,
+    'desc': lambda b: b.desc,
+}
+
+POST_FIELDS = {
+    'pid': lambda p: p.pid,
+    'bid': lambda p: p.bid,
+    'uid': lambda p: p.uid,
+    'author': lambda p: p.author.username,
+    'name': lambda p: p.name,
+    'text': lambda p: p.text,
+    'excerpt': lambda p: p.excerpt,
+    'html': lambda p: str(p.html_content),
+    'date': lambda p: _date(p.date),
+    'date_edited': lambda p: _date(p.date_edited),
+    'comment_count': lambda p: p.comment_count,
+    'last_activity_at': lambda p: _date(p.last_activity_at),
+}
+
+COMMENT_FIELDS = {
+    'cid': lambda c: c.cid,
+    'pid': lambda c: c.pid,
+    'uid': lambda c: c.uid,
+    'author': lambda c: c.author.username,
+    'text': lambda c: c.text,
+    'html': lambda c: str(c.html_content),
+    'date': lambda c: _date(c.date),
+    'date_edited': lambda c: _date(c.date_edited),
+}
+
+
+def _fields(available):
+    """
+    gets the requested sparse field selection, defaulting to every field
+    except rendered html
+    """
+    requested = request.args.get('fields')
+    if not requested:
+        return [name for name in available if name != 'html']
+    fields = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = [name for name in fields if name not in available]
+    if unknown:
+        abort(400, 'Unknown field(s): {}'.format(', '.join(unknown)))
+    return fields
+
+
+def _limit():
+    """
+    gets the requested page size capped at the resource limit
+    """
+    try:
+        limit = int(request.args.get('limit', constants.RESOURCE_LIMIT))
+    except ValueError:
+        abort(400, 'limit must be an integer')
+    return max(1, min(limit, constants.RESOURCE_LIMIT))
+
+
+def _ids():
+    """
+    gets the requested id list for batch fetches, if any
+    """
+    requested = request.args.get('ids')
+    if requested is None:
+        return None
+    try:
+        ids = [int(i) for i in requested.split(',') if i.strip()]
+    except ValueError:
+        abort(400, 'ids must be a comma separated list of integers')
+    if len(ids) > constants.RESOURCE_LIMIT:
+        abort(400, 'At most {} ids may be requested'.format(
+            constants.RESOURCE_LIMIT))
+    return ids
+
+
+def _with_html(query, fields):
+    """
+    loads stored renders only when the html field was requested
+    """
+    if 'html' in fields:
+        return query.options(undefer_group('rendered'))
+    return query
+
+
+def _serialize(rows, available, fields):
+    """
+    serializes rows down to the selected fields
+    """
+    return [{name: available[name](row) for name in fields} for row in rows]
+
+
+def _page(query, columns, available, fields, descending=True):
+    """
+    responds with a keyset paginated page of serialized rows
+    """
+    page = paginate(
+        query, columns,
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+        per_page=_limit(),
+        descending=descending)
+    return jsonify(
+        data=_serialize(page.items, available, fields),
+        next=page.next_cursor,
+        prev=page.prev_cursor)
+
+
+def _batch(query, key, ids, available, fields):
+    """
+    responds with the rows matching an id list in the order requested
+    """
+    rows = {getattr(row, key.key): row for row in query.filter(key.in_(ids))}
+    return jsonify(data=_serialize(
+        [rows[i] for i in ids if i in rows], available, fields))
+
+
+@API.errorhandler(404)
+@API.errorhandler(HTTPException)
+def api_error(error):
+    """
+    responds to api errors with json instead of html
+    """
+    return jsonify(error=error.description), error.code
+
+
+@API.route('/boards')
+@conditional
+def boards():
+    """
+    lists visible boards
+    """
+    fields = _fields(BOARD_FIELDS)
+    query = Board.query.filter_by(deleted=False)
+    ids = _ids()
+    if ids is not None:
+        return _batch(query, Board.bid, ids, BOARD_FIELDS, fields)
+    return _page(query, (Board.bid,), BOARD_FIELDS, fields, descending=False)
+
+
+@API.route('/boards/<int:bid>/posts')
+@conditional
+def board_posts(bid):
+    """
+    lists the posts of a board by most recent activity
+    """
+    Board.query.filter_by(bid=bid, deleted=False).first_or_404()
+    fields = _fields(POST_FIELDS)
+    query = _with_html(Post.query.filter(
+        Post.bid == bid, Post.deleted.is_(False)).options(
+            joinedload(Post.author)), fields)
+    return _page(
+        query, (Post.last_activity_at, Post.pid), POST_FIELDS, fields)
+
+
+@API.route('/posts')
+@conditional
+def posts():
+    """
+    batch fetches posts by id
+    """
+    ids = _ids()
+    if ids is None:
+        abort(400, 'ids is required')
+    fields = _fields(POST_FIELDS)
+    query = _with_html(Post.query.filter_by(deleted=False).options(
+        joinedload(Post.author)), fields)
+    return _batch(query, Post.pid, ids, POST_FIELDS, fields)
+
+
+@API.route('/posts/<int:pid>/comments')
+@conditional
+def post_comments(pid):
+    """
+    lists the comments of a post in the order they were made
+    """
+    Post.query.filter_by(pid=pid, deleted=False).first_or_404()
+    fields = _fields(COMMENT_FIELDS)
+    query = _with_html(Comment.query.filter(
+        Comment.pid == pid, Comment.deleted.is_(False)).options(
+            joinedload(Comment.author)), fields)
+    return _page(
+        query, (Comment.date, Comment.cid), COMMENT_FIELDS, fields,
+        descending=False)
+
+
+@API.route('/comments')
+@conditional
+def comments():
+    """
+    batch fetches comments by id
+    """
+    ids = _ids()
+    if ids is None:
+        abort(400, 'ids is required')
+    fields = _fields(COMMENT_FIELDS)
+    query = _with_html(Comment.query.filter_by(deleted=False).options(
+        joinedload(Comment.author)), fields)
+    return _batch(query, Comment.cid, ids, COMMENT_FIELDS, fields)
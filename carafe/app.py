@@ -1,41 +1,126 @@
 """ Carafe Application """
-from flask import Flask, request, render_template, redirect, url_for, flash
+import time
+from datetime import datetime
+
+from flask import (
+    Flask, Response, abort, current_app, request, render_template, redirect,
+    url_for, flash
+)
 from flask_login import (
     LoginManager, current_user, login_user, login_required, logout_user
 )
-from htmlmin.main import minify
 from passlib.hash import sha512_crypt as sha
-from sqlalchemy import text, func
+from sqlalchemy import func
+from sqlalchemy.orm import defer, joinedload, undefer_group
+from werkzeug.middleware.proxy_fix import ProxyFix
 
+from carafe.api import API
+from carafe.cli import CARAFE_CLI
 from carafe.config import load_config
-from carafe.extensions.login import AnonymousUser
+from carafe.extensions.assets import Assets
+from carafe.extensions.live import LiveComments
+from carafe.extensions.metrics import Metrics
+from carafe.extensions.login import AnonymousUser, PrincipalCache
+from carafe.extensions.minify import MinifyExtension
+from carafe.extensions.pagecache import (
+    PageCache, INDEX_SCOPE, board_scope, post_scope
+)
+from carafe.extensions.response import compress_response, conditional
+from carafe.extensions.startup import Startup
+from carafe.extensions.throttle import Throttle
+from carafe.extensions.views import Views
+from carafe.database.base import OEMBED_PROVIDERS
 from carafe.database.model import Board, Post, Comment, User, DB
+from carafe.database.pagination import Page, paginate
+from carafe.database.routing import replica_reads
+from carafe.database.search import search_backend, search as search_content
+from carafe.database.stats import AdminStats
+from carafe.database.upgrade import upgrade as upgrade_schema
+from carafe.tasks import JOBS
 from carafe.forms import (
     BoardForm, PostForm, CommentForm, LoginForm, SignupForm
 )
 from carafe import constants
 
-# APP INIT
-APP = Flask(__name__)
-load_config(APP)
-DB.init_app(APP)
-DB.app = APP
+# EXTENSIONS, configured for each application by create_app
+VIEWS = Views()
+PAGE_CACHE = PageCache()
 LOGIN_MANAGER = LoginManager()
 LOGIN_MANAGER.anonymous_user = AnonymousUser
-LOGIN_MANAGER.init_app(APP)
+USER_CACHE = PrincipalCache()
+USER_CACHE.watch(User)
+ADMIN_STATS = AdminStats()
+METRICS = Metrics()
+LIVE = LiveComments()
+ASSETS = Assets()
+THROTTLE = Throttle()
+STARTUP = Startup()
+
+
+def create_app(config=None):
+    """
+    creates and configures an application, overriding the environment
+    configuration with the provided mapping; heavy components are built on
+    first use and templates and markdown are warmed up unless WARMUP is off
+    """
+    started = time.perf_counter()
+    app = Flask(__name__)
+    load_config(app)
+    app.config.update(config or {})
+    if app.config['PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXIES'])
+    DB.init_app(app)
+    OEMBED_PROVIDERS.init_app(app)
+    PAGE_CACHE.init_app(app)
+    LOGIN_MANAGER.init_app(app)
+    USER_CACHE.init_app(app)
+    ADMIN_STATS.init_app(app)
+    METRICS.init_app(app)
+    JOBS.init_app(app)
+    LIVE.init_app(app)
+    ASSETS.init_app(app)
+    THROTTLE.init_app(app)
+    VIEWS.init_app(app)
+    app.cli.add_command(CARAFE_CLI)
+    app.register_blueprint(API)
+    app.jinja_env.add_extension(MinifyExtension)
+    STARTUP.init_app(app)
+    STARTUP.record('create_app', time.perf_counter() - started)
+    if app.config['WARMUP']:
+        STARTUP.warm_up()
+    return app
 
 # DATABASE HELPERS
 
 
-def create_database_tables():
+def create_database_tables(app):
     """
     initializes database in the proper application context
     """
-    with APP.app_context():
+    with app.app_context():
         DB.create_all()
+        upgrade_schema()
+        search_backend().install()
+        DB.session.commit()
+
+
+def comment_page(pid):
+    """
+    gets the page of a post's comments requested by the after, before or
+    latest query arguments, in the order they were made
+    """
+    return paginate(
+        Comment.query.filter(Comment.pid == pid).options(
+            undefer_group('rendered'), joinedload(Comment.author)),
+        (Comment.date, Comment.cid),
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+        per_page=current_app.config['COMMENTS_PER_PAGE'],
+        descending=False,
+        from_end='latest' in request.args)
 
 # ERROR HANDLER
-@APP.errorhandler(404)
+@VIEWS.errorhandler(404)
 def page_not_found(_error):
     """
     error handler for 404
@@ -43,16 +128,23 @@ def page_not_found(_error):
     return render_template('404.html'), 404
 
 
-# HTML Response Decorator to Minimize HTML
-@APP.after_request
-def response_minify(response):
+@VIEWS.errorhandler(429)
+def too_many_requests(error):
     """
-    minifies html response
+    error handler for throttled submissions
     """
-    if response.content_type == u'text/html; charset=utf-8':
-        response.set_data(minify(response.get_data(as_text=True)))
-        return response
-    return response
+    return render_template('429.html'), 429, [
+        header for header in error.get_headers()
+        if header[0] == 'Retry-After']
+
+
+# Compress responses, templates are already minified when compiled
+@VIEWS.after_request
+def response_compress(response):
+    """
+    compresses responses for clients that accept it
+    """
+    return compress_response(response)
 
 
 # Login Manager Decorators
@@ -69,21 +161,24 @@ def load_user(uid):
     """
     callback that is used to reload user object from the User uid
     """
-    return User.query.get(uid)
+    return USER_CACHE.load(uid, User.query.get)
 
 # Routes
-@APP.route('/', methods=constants.METHODS)
+@VIEWS.route('/', methods=constants.METHODS)
+@replica_reads
+@conditional
+@PAGE_CACHE.cached(lambda: (INDEX_SCOPE,))
 def index():
     """
     application index route
     """
     return render_template(
         'index.html',
-        boards=Board.query.filter_by(deleted=False),
+        boards=Board.get_summaries(),
         form=BoardForm())
 
 
-@APP.route('/admin/panel', methods=constants.METHODS)
+@VIEWS.route('/admin/panel', methods=constants.METHODS)
 @login_required
 def panel():
     """
@@ -92,51 +187,147 @@ def panel():
     if current_user.is_admin:
         return render_template(
             'panel.html',
-            User=User,
-            Post=Post,
-            Comment=Comment,
-            Board=Board)
+            totals=ADMIN_STATS.totals(),
+            boards=ADMIN_STATS.boards(
+                after=request.args.get('after'),
+                before=request.args.get('before'),
+                per_page=current_app.config['ADMIN_PER_PAGE']),
+            users=ADMIN_STATS.top_users(),
+            cache_stats=PAGE_CACHE.stats(),
+            user_cache_stats=USER_CACHE.stats())
     return redirect(url_for('index'))
 
 
-@APP.route('/board/<bid>')
+@VIEWS.route('/admin/archive')
+@login_required
+def archive_content():
+    """
+    admin route queueing the archival of old deleted posts and comments
+    """
+    if current_user.is_admin:
+        JOBS.enqueue('archive')
+        DB.session.commit()
+        flash('Content deleted more than {} days ago is being archived.'
+              .format(current_app.config['ARCHIVE_AFTER_DAYS']))
+    else:
+        flash(constants.DEFAULT_SUBMISSION_ERR)
+    return redirect(request.referrer or url_for('panel'))
+
+
+@VIEWS.route('/admin/metrics')
+def metrics():
+    """
+    prometheus metrics for admins and scrapers holding the metrics token
+    """
+    if not (current_user.is_admin or METRICS.authorized()):
+        abort(403)
+    return Response(
+        METRICS.exposition(), mimetype='text/plain; version=0.0.4')
+
+
+@VIEWS.route('/board/<bid>')
+@replica_reads
+@conditional
+@PAGE_CACHE.cached(lambda bid: (board_scope(bid),))
 def board(bid):
     """
     view that displays the post of the board specified by the provided bid
     """
     form = PostForm(request.form)
-    posts = Post.query.filter_by(
-        bid=bid, deleted=False).outerjoin(Comment).order_by(
-            text("comment.date desc"))
+    page = paginate(
+        Post.query.filter(Post.bid == bid, Post.deleted.is_(False)).options(
+            defer(Post.text), joinedload(Post.author)),
+        (Post.last_activity_at, Post.pid),
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+        per_page=current_app.config['PER_PAGE'])
     brd = Board.query.get(bid)
-    return render_template('posts.html', posts=posts, b=brd, pform=form)
+    return render_template(
+        'posts.html', posts=page.items, page=page, b=brd, pform=form)
 
 
-@APP.route('/board/<bid>/post/<pid>', methods=constants.METHODS)
+@VIEWS.route('/board/<bid>/post/<pid>', methods=constants.METHODS)
+@replica_reads
+@conditional
+@PAGE_CACHE.cached(lambda bid, pid: (post_scope(pid),))
 def post(bid, pid):
     """
     post route
     """
-    pst = Post.query.get(pid)
+    pst = Post.query.options(
+        undefer_group('rendered'), joinedload(Post.author)).get(pid)
     if pst.deleted:
         flash('The post you are trying to access has been deleted.')
         return redirect(url_for('board', bid=bid))
-    comments = Comment.query.filter_by(pid=pid).order_by(text("date asc"))
     return render_template(
         'post.html',
         p=pst,
         bid=bid,
-        comments=comments,
+        pid=pst.pid,
+        page=comment_page(pid),
+        older=True,
+        newer=True,
         pform=PostForm(),
         cform=CommentForm())
 
 
-@APP.route('/signup', methods=constants.METHODS)
+@VIEWS.route('/board/<bid>/post/<pid>/comments')
+@replica_reads
+@conditional
+@PAGE_CACHE.cached(lambda bid, pid: (post_scope(pid),))
+def post_comments(bid, pid):
+    """
+    html fragment holding a further page of a post's comments, followed or
+    preceded by a link to the next page in the same direction
+    """
+    Post.query.filter_by(bid=bid, pid=pid, deleted=False).first_or_404()
+    backward = 'before' in request.args
+    return render_template(
+        'comments.html',
+        bid=bid,
+        pid=pid,
+        page=comment_page(pid),
+        older=backward,
+        newer=not backward)
+
+
+@VIEWS.route('/board/<bid>/post/<pid>/live')
+@replica_reads
+def live_comments(bid, pid):
+    # pylint: disable=unused-argument
+    """
+    event stream of the comment changes on a post
+    """
+    pid = Post.query.filter_by(pid=pid, deleted=False).first_or_404().pid
+    # the stream can stay open for hours, so it must not hold a connection
+    DB.session.remove()
+    return LIVE.stream(pid)
+
+
+@VIEWS.route('/search')
+@replica_reads
+def search():
+    """
+    full text search of posts and comments
+    """
+    terms = request.args.get('q', '').strip()[:constants.SEARCH_LIMIT]
+    hits = search_content(
+        terms,
+        after=request.args.get('after'),
+        per_page=current_app.config['SEARCH_PER_PAGE']) if terms else Page([])
+    return render_template(
+        'search.html', q=terms, hits=hits,
+        max_length=constants.SEARCH_LIMIT)
+
+
+@VIEWS.route('/signup', methods=constants.METHODS)
+@THROTTLE.limit('sign_up')
 def sign_up():
     """
     user registration route
     """
-    if not current_user.is_admin and not APP.config['REGISTRATION_FLAG']:
+    if not current_user.is_admin and \
+            not current_app.config['REGISTRATION_FLAG']:
         flash('Sorry, user registration is disabled.')
         return redirect(url_for('index'))
 
@@ -169,7 +360,8 @@ def sign_up():
     return render_template('signup.html', form=form)
 
 
-@APP.route("/login", methods=constants.METHODS)
+@VIEWS.route("/login", methods=constants.METHODS)
+@THROTTLE.limit('login')
 def login():
     """
     logs in user if proper parameters are entered and creates a session for
@@ -190,7 +382,7 @@ def login():
     return render_template('login.html', form=form)
 
 
-@APP.route("/logout")
+@VIEWS.route("/logout")
 @login_required
 def logout():
     """
@@ -201,7 +393,7 @@ def logout():
     return redirect(request.referrer)
 
 
-@APP.route('/board/create', methods=constants.METHODS)
+@VIEWS.route('/board/create', methods=constants.METHODS)
 def create_board():
     """
     creates board if form parameters meet requirements
@@ -213,16 +405,49 @@ def create_board():
         ).scalar() is None:
             DB.session.add(Board(form.name.data, form.desc.data))
             DB.session.commit()
+            PAGE_CACHE.bump(INDEX_SCOPE)
             flash('Board ({}) successfully created!'.format(form.name.data))
         else:
             flash('Duplicate board detected.')
     return render_template(
         'index.html',
-        boards=Board.query.filter_by(deleted=False),
+        boards=Board.get_summaries(),
         form=form)
 
 
-@APP.route('/board/edit/<bid>', methods=constants.METHODS)
+@VIEWS.route('/edit/<kind>/<int:key>')
+@login_required
+def edit_form(kind, key):
+    """
+    html fragment holding the edit form of a board, post or comment, fetched
+    when its author or an admin expands it so listings need not build a form
+    for every row
+    """
+    if kind == 'board':
+        brd = Board.query.get_or_404(key)
+        if not current_user.is_admin:
+            abort(403)
+        return render_template(
+            'form/editboard_form.html', b=brd, form=brd.get_edit_form())
+    if kind == 'post':
+        pst = Post.query.get_or_404(key)
+        if current_user.uid != pst.uid and not current_user.is_admin:
+            abort(403)
+        return render_template(
+            'form/editpost_form.html', p=pst, pform=pst.get_edit_form())
+    if kind == 'comment':
+        comment = Comment.query.get_or_404(key)
+        if current_user.uid != comment.uid or comment.deleted:
+            abort(403)
+        return render_template(
+            'form/editcomment_form.html',
+            c=comment,
+            bid=DB.session.query(Post.bid).filter_by(pid=comment.pid).scalar(),
+            cform=comment.get_edit_form())
+    abort(404)
+
+
+@VIEWS.route('/board/edit/<bid>', methods=constants.METHODS)
 def edit_board(bid):
     """
     allows the editing of a board with the provided bid
@@ -235,13 +460,14 @@ def edit_board(bid):
                 brd.name = form.name.data
                 brd.desc = form.desc.data
                 DB.session.commit()
+                PAGE_CACHE.bump(INDEX_SCOPE, board_scope(bid))
                 flash('Board ({}) successfully edited!'.format(form.name.data))
         else:
             flash(constants.DEFAULT_SUBMISSION_ERR)
     return redirect(request.referrer)
 
 
-@APP.route('/board/<bid>/delete')
+@VIEWS.route('/board/<bid>/delete')
 @login_required
 def delete_board(bid):
     """
@@ -250,13 +476,15 @@ def delete_board(bid):
     if current_user.is_admin:
         Board.query.get(bid).deleted = True
         DB.session.commit()
+        PAGE_CACHE.bump(INDEX_SCOPE, board_scope(bid))
         flash('Board {} is no longer viewable.'.format(bid))
     return redirect(request.referrer)
 
 
 # POST VIEWS
-@APP.route('/board/<bid>/post/create', methods=constants.METHODS)
+@VIEWS.route('/board/<bid>/post/create', methods=constants.METHODS)
 @login_required
+@THROTTLE.limit('post')
 def create_post(bid):
     """
     allows the creation of a post as long as parameters are met and the user
@@ -265,20 +493,19 @@ def create_post(bid):
     form = PostForm(request.form)
     if request.method == 'POST':
         if form.validate():
-            DB.session.add(
-                Post(
-                    bid,
-                    current_user.uid,
-                    form.name.data,
-                    form.desc.data))
+            pst = Post(bid, current_user.uid, form.name.data, form.desc.data)
+            DB.session.add(pst)
+            DB.session.flush()
+            JOBS.enqueue('render', 'post', pst.pid)
             DB.session.commit()
+            PAGE_CACHE.bump(INDEX_SCOPE, board_scope(bid))
             flash('Post ({}) successfully created!'.format(form.name.data))
         else:
             flash(constants.DEFAULT_SUBMISSION_ERR)
     return redirect(request.referrer)
 
 
-@APP.route('/board/<bid>/post/<pid>/edit', methods=constants.METHODS)
+@VIEWS.route('/board/<bid>/post/<pid>/edit', methods=constants.METHODS)
 @login_required
 def edit_post(bid, pid):
     # pylint: disable=unused-argument
@@ -294,14 +521,17 @@ def edit_post(bid, pid):
                 og_name = pst.name
                 pst.name = form.name.data
                 pst.text = form.desc.data
+                JOBS.enqueue('render', 'post', pst.pid)
                 DB.session.commit()
+                PAGE_CACHE.bump(
+                    INDEX_SCOPE, board_scope(pst.bid), post_scope(pid))
                 flash('Post ({}) successfully edited!'.format(og_name))
         else:
             flash(constants.DEFAULT_SUBMISSION_ERR)
     return redirect(request.referrer)
 
 
-@APP.route('/board/<bid>/post/<pid>/delete')
+@VIEWS.route('/board/<bid>/post/<pid>/delete')
 @login_required
 def delete_post(bid, pid):
     # pylint: disable=unused-argument
@@ -310,14 +540,18 @@ def delete_post(bid, pid):
     creator or admin
     """
     if current_user.is_admin or current_user == Post.query.get(int(pid)).uid:
-        Post.query.get(pid).deleted = True
+        pst = Post.query.get(pid)
+        pst.deleted = True
+        pst.deleted_at = datetime.now()
         DB.session.commit()
+        PAGE_CACHE.bump(INDEX_SCOPE, board_scope(bid), post_scope(pid))
     return redirect(request.referrer)
 
 
 # COMMENT VIEWS
-@APP.route('/board/<bid>/post/<pid>/comment', methods=constants.METHODS)
+@VIEWS.route('/board/<bid>/post/<pid>/comment', methods=constants.METHODS)
 @login_required
+@THROTTLE.limit('comment')
 def create_comment(bid, pid):
     # pylint: disable=unused-argument
     """
@@ -326,15 +560,22 @@ def create_comment(bid, pid):
     form = CommentForm(request.form)
     if request.method == 'POST':
         if form.validate():
-            DB.session.add(Comment(pid, current_user.uid, form.text.data))
+            comment = Comment(pid, current_user.uid, form.text.data)
+            DB.session.add(comment)
+            DB.session.flush()
+            cid = comment.cid
+            JOBS.enqueue('render', 'comment', cid)
+            Post.record_comment(pid, comment.date)
             DB.session.commit()
+            PAGE_CACHE.bump(board_scope(bid), post_scope(pid))
+            LIVE.publish(pid, cid, 'created')
             flash('Comment successfully created!')
         else:
             flash(constants.DEFAULT_SUBMISSION_ERR)
     return redirect(request.referrer)
 
 
-@APP.route(
+@VIEWS.route(
     '/board/<bid>/post/<pid>/comment/<cid>/edit',
     methods=constants.METHODS)
 @login_required
@@ -350,14 +591,17 @@ def edit_comment(bid, pid, cid):
         if form.validate():
             if comment.text != form.text.data:
                 comment.text = form.text.data
+                JOBS.enqueue('render', 'comment', comment.cid)
                 DB.session.commit()
+                PAGE_CACHE.bump(post_scope(pid))
+                LIVE.publish(pid, cid, 'edited')
                 flash('Comment successfully edited!')
         else:
             flash(constants.DEFAULT_SUBMISSION_ERR)
     return redirect(request.referrer)
 
 
-@APP.route('/board/<bid>/post/<pid>/comment/<cid>/delete')
+@VIEWS.route('/board/<bid>/post/<pid>/comment/<cid>/delete')
 @login_required
 def delete_comment(bid, pid, cid):
     # pylint: disable=unused-argument
@@ -367,11 +611,16 @@ def delete_comment(bid, pid, cid):
     comment = Comment.query.filter_by(pid=pid, cid=cid).first()
     if current_user.is_admin or current_user.uid == comment.uid:
         comment.deleted = True
+        comment.deleted_at = datetime.now()
+        DB.session.flush()
+        Post.refresh_activity(comment.pid)
         DB.session.commit()
+        PAGE_CACHE.bump(board_scope(bid), post_scope(pid))
+        LIVE.publish(pid, cid, 'deleted')
     return redirect(request.referrer)
 
 
-@APP.route('/board/<bid>/post/<pid>/comment/<cid>/revive')
+@VIEWS.route('/board/<bid>/post/<pid>/comment/<cid>/revive')
 def revive_comment(bid, pid, cid):
     # pylint: disable=unused-argument
     """
@@ -380,38 +629,54 @@ def revive_comment(bid, pid, cid):
     comment = Comment.query.filter_by(pid=pid, cid=cid).first()
     if current_user.is_admin:
         comment.deleted = False
+        comment.deleted_at = None
+        DB.session.flush()
+        Post.refresh_activity(comment.pid)
         DB.session.commit()
+        PAGE_CACHE.bump(board_scope(bid), post_scope(pid))
+        LIVE.publish(pid, cid, 'revived')
     return redirect(request.referrer)
 
 
-@APP.route('/admin/board/<bid>/erase')
+@VIEWS.route('/admin/board/<bid>/erase')
 @login_required
 def erase_board(bid):
     """
-    admin "erase" board route
+    admin "erase" board route, the board is hidden at once and removed from
+    the database in the background; erasing picks up where it left off, so
+    a board whose erase failed part way can be erased again
     """
-    if current_user.is_admin:
-        DB.session.delete(Board.query.get(bid))
+    brd = Board.query.get(bid)
+    if current_user.is_admin and brd is not None:
+        brd.deleted = True
+        brd.erasing = True
+        JOBS.enqueue('erase_board', brd.bid)
         DB.session.commit()
-        msg = 'Board {} permanently removed from database. '\
-            'All associated posts and comments have also been removed.'
+        PAGE_CACHE.bump(INDEX_SCOPE, board_scope(bid))
+        msg = 'Board {} is being permanently removed from database. '\
+            'All associated posts and comments will also be removed.'
         flash(msg.format(bid))
     else:
         flash(constants.DEFAULT_SUBMISSION_ERR)
     return redirect(request.referrer)
 
 
-@APP.route('/admin/board/<bid>/revive')
+@VIEWS.route('/admin/board/<bid>/revive')
 @login_required
 def revive_board(bid):
     """
     admin revive board route
     """
-    if current_user.is_admin:
-        Board.query.get(bid).deleted = False
+    brd = Board.query.get(bid)
+    if current_user.is_admin and not brd.erasing:
+        brd.deleted = False
         DB.session.commit()
+        PAGE_CACHE.bump(INDEX_SCOPE, board_scope(bid))
         msg = 'Board {} is now visible again.'
         flash(msg.format(bid))
     else:
         flash(constants.DEFAULT_SUBMISSION_ERR)
     return redirect(request.referrer)
+
+
+STARTUP.imported()
@@ -0,0 +1,231 @@
+""" Carafe Benchmarks """
+
+import random
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from passlib.hash import sha512_crypt as sha
+from sqlalchemy import event
+
+from carafe.database.model import Post, DB
+from carafe.signals import CONTENT_RENDERED
+
+ROUTES = ('index', 'board', 'post', 'create_comment', 'panel')
+
+# the most sql statements a single request to each route may execute
+QUERY_BUDGETS = {
+    'index': 2,
+    'board': 3,
+    'post': 4,
+    'create_comment': 5,
+    'panel': 8,
+}
+
+WORDS = (
+    'carafe board thread reply query index cache worker render markdown '
+    'pygments flask database session cursor commit latency request page '
+    'template python postgres sqlite shard replica benchmark profile row '
+    'column the a of and to in is it that for on with as was this be'
+).split()
+
+CODE = (
+    'def {0}(items):\n    """ {1} """\n    total = 0\n'
+    '    for item in items:\n        total += len(item)\n    return total\n',
+    'SELECT pid, name FROM post\nWHERE bid = {2}\nORDER BY date DESC;\n',
+    'for (let i = 0; i < {2}; i++) {{\n    console.log("{0}", i);\n}}\n',
+)
+
+RouteStats = namedtuple('RouteStats', [
+    'route', 'requests', 'p50', 'p95', 'queries', 'max_queries', 'render',
+    'budget'])
+
+
+def _sentence(rng, low=6, high=18):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(low, high))]
+    return ' '.join(words).capitalize() + '.'
+
+
+def markdown_body(rng, paragraphs=3):
+    """
+    builds a markdown document resembling forum content with paragraphs,
+    emphasis, lists, quotes, links and fenced code
+    """
+    blocks = []
+    for _ in range(rng.randint(1, paragraphs)):
+        blocks.append(' '.join(
+            _sentence(rng) for _ in range(rng.randint(1, 4))))
+        roll = rng.random()
+        if roll < 0.25:
+            blocks.append('\n'.join(
+                '- **{}** {}'.format(rng.choice(WORDS), _sentence(rng, 3, 8))
+                for _ in range(rng.randint(2, 5))))
+        elif roll < 0.45:
+            code = rng.choice(CODE).format(
+                rng.choice(WORDS), _sentence(rng, 2, 5), rng.randint(1, 100))
+            blocks.append('```{}\n{}```'.format(
+                rng.choice(('python', 'sql', 'javascript')), code))
+        elif roll < 0.55:
+            blocks.append('> ' + _sentence(rng))
+        elif roll < 0.65:
+            blocks.append('See [the {0} notes](https://example.com/{0}) '
+                          'and `{1}()`.'.format(
+                              rng.choice(WORDS), rng.choice(WORDS)))
+    return '\n\n'.join(blocks)
+
+
+def generate(seed=0, users=20, boards=5, posts=200, comments=2000):
+    """
+    yields a reproducible synthetic forum as export records that the
+    transfer Importer can load; the first user is an admin
+    """
+    rng = random.Random(seed)
+    password = sha.hash('benchmark')
+    start = datetime.utcnow() - timedelta(days=365)
+
+    for uid in range(1, users + 1):
+        yield {
+            'type': 'user', 'uid': uid, 'username': 'user{}'.format(uid),
+            'email': 'user{}@example.com'.format(uid), 'password': password,
+            'is_active': True, 'is_anonymous': False,
+            'is_authenticated': True, 'is_confirmed': True,
+            'is_admin': uid == 1}
+    for bid in range(1, boards + 1):
+        yield {
+            'type': 'board', 'bid': bid, 'name': 'Board {}'.format(bid),
+            'desc': _sentence(rng), 'deleted': False}
+
+    dates = {}
+    for pid in range(1, posts + 1):
+        dates[pid] = start + timedelta(seconds=rng.randint(0, 300 * 86400))
+        yield {
+            'type': 'post', 'pid': pid, 'bid': rng.randint(1, boards),
+            'uid': rng.randint(1, users), 'date': dates[pid].isoformat(),
+            'date_edited': None, 'name': _sentence(rng, 3, 8)[:-1],
+            'text': markdown_body(rng, 5), 'deleted': rng.random() < 0.02}
+    # comments cluster on a minority of busy threads like real forums
+    for cid in range(1, comments + 1):
+        pid = min(int(rng.paretovariate(1.2)), posts) if rng.random() < 0.5 \
+            else rng.randint(1, posts)
+        date = dates[pid] + timedelta(seconds=rng.randint(60, 60 * 86400))
+        yield {
+            'type': 'comment', 'cid': cid, 'pid': pid,
+            'uid': rng.randint(1, users), 'date': date.isoformat(),
+            'date_edited': None, 'text': markdown_body(rng, 2),
+            'deleted': rng.random() < 0.02}
+
+
+class Recorder:
+    """
+    counts sql statements and markdown render time of the thread making
+    requests while it is active, leaving out background jobs
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.thread = threading.get_ident()
+        self.queries = 0
+        self.render = 0.0
+
+    def _query(self, *_args):
+        if threading.get_ident() == self.thread:
+            self.queries += 1
+
+    def _rendered(self, _sender, duration):
+        if threading.get_ident() == self.thread:
+            self.render += duration
+
+    def reset(self):
+        """
+        zeroes the counters between requests
+        """
+        self.queries, self.render = 0, 0.0
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._query)
+        CONTENT_RENDERED.connect(self._rendered)
+        return self
+
+    def __exit__(self, *_exc):
+        event.remove(self.engine, 'before_cursor_execute', self._query)
+        CONTENT_RENDERED.disconnect(self._rendered)
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def _requests(rng, admin):
+    """
+    maps each route to a callable making one request to it against
+    randomly chosen live content
+    """
+    posts = DB.session.query(Post.pid, Post.bid).filter(
+        Post.deleted.is_(False)).all()
+    bids = sorted({bid for _, bid in posts})
+    DB.session.remove()
+
+    def pick():
+        return rng.choice(posts)
+
+    def comment(client):
+        pid, bid = pick()
+        path = '/board/{}/post/{}'.format(bid, pid)
+        return client.post(
+            path + '/comment', data={'text': markdown_body(rng, 1)},
+            headers={'Referer': path})
+
+    return {
+        'index': lambda client: client.get('/'),
+        'board': lambda client: client.get(
+            '/board/{}'.format(rng.choice(bids))),
+        'post': lambda client: client.get(
+            '/board/{1}/post/{0}'.format(*pick())),
+        'create_comment': comment,
+        'panel': lambda client: admin.get('/admin/panel'),
+    }
+
+
+def run(app, routes=ROUTES, iterations=50, seed=0, budgets=None):
+    """
+    drives the test client over the routes, returning RouteStats for each;
+    reads are made anonymously and writes and the panel as the admin
+    """
+    budgets = dict(QUERY_BUDGETS, **(budgets or {}))
+    rng = random.Random(seed)
+    anonymous, admin = app.test_client(), app.test_client()
+    with admin.session_transaction() as session:
+        session['_user_id'] = '1'
+        session['_fresh'] = True
+
+    with app.app_context():
+        requests = _requests(rng, admin)
+        engine = DB.engine
+    results = []
+    with Recorder(engine) as recorder:
+        for route in routes:
+            client = admin if route in ('create_comment', 'panel') \
+                else anonymous
+            latencies, queries, renders = [], [], []
+            # one unmeasured request warms templates and connections
+            requests[route](client)
+            for _ in range(iterations):
+                recorder.reset()
+                started = time.perf_counter()
+                response = requests[route](client)
+                latencies.append(time.perf_counter() - started)
+                if response.status_code >= 400:
+                    raise RuntimeError('{} responded with {}'.format(
+                        route, response.status_code))
+                queries.append(recorder.queries)
+                renders.append(recorder.render)
+            results.append(RouteStats(
+                route, iterations,
+                _percentile(latencies, 50) * 1000,
+                _percentile(latencies, 95) * 1000,
+                sum(queries) / iterations, max(queries),
+                sum(renders) / iterations * 1000,
+                budgets.get(route)))
+    return results
@@ -0,0 +1,287 @@
+""" Carafe Commands """
+
+import json
+import os
+import tempfile
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.orm import undefer_group
+from carafe import bench as benchmarks
+from carafe.database import archive as archival
+from carafe.database.base import OEMBED_PROVIDERS
+from carafe.database.model import Board, Post, Comment, DB
+from carafe.database.search import search_backend
+from carafe.database.transfer import Importer, export_jsonl
+from carafe.database.upgrade import upgrade as upgrade_schema
+from carafe.extensions.assets import AssetError, build as build_assets
+from carafe.extensions.pagecache import INDEX_SCOPE, board_scope
+from carafe.tasks import JOBS
+
+CARAFE_CLI = AppGroup('carafe', help='Carafe maintenance commands.')
+
+
+@CARAFE_CLI.command('upgrade')
+def upgrade():
+    """
+    adds columns and indexes that newer versions introduced to the tables
+    of an existing database; run it before reconcile or render
+    """
+    added = upgrade_schema()
+    click.echo('Added {}.'.format(', '.join(added)) if added
+               else 'Schema is up to date.')
+
+
+@CARAFE_CLI.command('reconcile')
+def reconcile():
+    """
+    repairs drifted post comment counters and activity dates
+    """
+    upgrade_schema()
+    repaired = Post.refresh_activity()
+    DB.session.commit()
+    click.echo('Reconciled activity for {} post(s).'.format(repaired))
+
+
+@CARAFE_CLI.command('render')
+@click.option('--batch-size', default=500, show_default=True)
+def render(batch_size):
+    """
+    renders post and comment html and post excerpts that are missing or out
+    of date
+    """
+    upgrade_schema()
+    with OEMBED_PROVIDERS.blocking():
+        _render_all(batch_size)
+
+
+def _render_all(batch_size):
+    """
+    renders every stale post and comment in primary key batches
+    """
+    for model, key in ((Post, Post.pid), (Comment, Comment.cid)):
+        rendered, last = 0, 0
+        while True:
+            batch = model.query.options(undefer_group('rendered')).filter(
+                key > last).order_by(key).limit(batch_size).all()
+            if not batch:
+                break
+            for row in batch:
+                if not row.is_rendered:
+                    row.render()
+                    rendered += 1
+            last = getattr(batch[-1], key.key)
+            DB.session.commit()
+        click.echo('Rendered {} {}(s).'.format(rendered, model.__tablename__))
+
+
+@CARAFE_CLI.command('assets')
+def assets():
+    """
+    bundles, fingerprints and precompresses the static files, failing when
+    anything references a file that does not exist
+    """
+    try:
+        manifest = build_assets(
+            current_app.static_folder,
+            os.path.join(current_app.root_path, current_app.template_folder),
+            current_app.config['ASSETS_BUILD'])
+    except AssetError as error:
+        raise click.ClickException(str(error))
+    click.echo('Built {} asset(s), restart the application to serve them.'
+               .format(len(manifest)))
+
+
+@CARAFE_CLI.command('search-index')
+def search_index():
+    """
+    installs the full text search index and indexes existing content
+    """
+    search_backend().rebuild()
+    DB.session.commit()
+    click.echo('Search index rebuilt.')
+
+
+@CARAFE_CLI.command('worker')
+@click.option('--once', is_flag=True,
+              help='Exit once no jobs are due instead of polling.')
+@click.option('--poll', default=1.0, show_default=True,
+              help='Seconds to wait between polls of an empty queue.')
+def worker(once, poll):
+    """
+    runs background jobs queued in the database
+    """
+    succeeded = JOBS.work(once=once, poll=poll)
+    click.echo('Ran {} job(s).'.format(succeeded))
+
+
+def _progress(verb):
+    return lambda kind, count: click.echo(
+        '{} {} {}(s).'.format(verb, count, kind), err=True)
+
+
+@CARAFE_CLI.command('archive')
+@click.option('--older-than', type=int, metavar='DAYS',
+              help='Archive content deleted more than DAYS ago. Defaults '
+                   'to CARAFE_ARCHIVE_AFTER_DAYS.')
+@click.option('--batch-size', type=int,
+              help='Rows per transaction. Defaults to CARAFE_DELETE_BATCH.')
+def archive(older_than, batch_size):
+    """
+    moves old soft deleted posts and comments into the archive tables
+    """
+    config = current_app.config
+    counts = archival.archive_deleted(
+        config['ARCHIVE_AFTER_DAYS'] if older_than is None else older_than,
+        batch_size or config['DELETE_BATCH'], _progress('Archived'))
+    click.echo('Archived {} post(s) and {} comment(s).'.format(
+        counts['post'], counts['comment']))
+
+
+@CARAFE_CLI.command('erase-board')
+@click.argument('bid', type=int)
+@click.option('--batch-size', type=int,
+              help='Rows per transaction. Defaults to CARAFE_DELETE_BATCH.')
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+def erase_board(bid, batch_size, yes):
+    """
+    permanently removes a board with its posts and comments
+    """
+    if not yes:
+        click.confirm(
+            'Board {} and everything posted on it will be removed for '
+            'good. Continue?'.format(bid), abort=True)
+    # hide the board while it is erased, as the admin panel does
+    if Board.query.filter_by(bid=bid).update(
+            {Board.deleted: True, Board.erasing: True},
+            synchronize_session=False):
+        DB.session.commit()
+        current_app.extensions['carafe_page_cache'].bump(
+            INDEX_SCOPE, board_scope(bid))
+    counts = archival.erase_board(
+        bid, batch_size or current_app.config['DELETE_BATCH'],
+        _progress('Removed'))
+    click.echo('Erased board {}: {}.'.format(bid, ', '.join(
+        '{} {}(s)'.format(count, kind) for kind, count in counts.items())))
+
+
+@CARAFE_CLI.command('export')
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help='File to write to, defaults to stdout.')
+@click.option('--batch-size', default=5000, show_default=True)
+def export(output, batch_size):
+    """
+    streams users, boards, posts and comments out as json lines
+    """
+    counts = export_jsonl(output, batch_size)
+    click.echo(', '.join(
+        '{} {}(s)'.format(count, kind) for kind, count in counts.items()),
+        err=True)
+
+
+@CARAFE_CLI.command('import')
+@click.argument('source', type=click.File('r'))
+@click.option('--batch-size', default=5000, show_default=True)
+@click.option('--checkpoint', metavar='NAME',
+              help='Name to record progress under in the database so an '
+                   'interrupted import can be resumed by running it again.')
+def import_(source, batch_size, checkpoint):
+    """
+    loads an export into the database, merging users and boards that
+    already exist by name
+    """
+    importer = Importer(checkpoint=checkpoint, batch_size=batch_size)
+    counts = importer.load(
+        source, progress=lambda line: click.echo(
+            'Imported {} line(s).'.format(line), err=True))
+    click.echo('Imported {}.'.format(', '.join(
+        '{} {}(s)'.format(count, kind) for kind, count in counts.items())
+        or 'nothing'))
+    click.echo('Run "flask carafe render" to render the imported content.')
+
+
+def _budgets(_ctx, _param, values):
+    """
+    parses ROUTE=QUERIES budget overrides
+    """
+    budgets = {}
+    for value in values:
+        route, _, queries = value.partition('=')
+        if route not in benchmarks.ROUTES or not queries.isdigit():
+            raise click.BadParameter(
+                '{} is not of the form ROUTE=QUERIES'.format(value))
+        budgets[route] = int(queries)
+    return budgets
+
+
+@CARAFE_CLI.command('bench')
+@click.option('--database',
+              help='Database to seed and benchmark; its carafe tables are '
+                   'dropped. Defaults to a temporary sqlite file.')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--users', default=20, show_default=True)
+@click.option('--boards', default=5, show_default=True)
+@click.option('--posts', default=200, show_default=True)
+@click.option('--comments', default=2000, show_default=True)
+@click.option('--iterations', default=50, show_default=True)
+@click.option('--route', 'routes', multiple=True,
+              type=click.Choice(benchmarks.ROUTES),
+              help='Route to benchmark, may be repeated. Defaults to all.')
+@click.option('--budget', 'budgets', multiple=True, callback=_budgets,
+              metavar='ROUTE=QUERIES', help='Overrides a query budget.')
+@click.option('--yes', is_flag=True,
+              help='Do not ask before dropping the tables of --database.')
+def bench(database, seed, users, boards, posts, comments, iterations,
+          routes, budgets, yes):
+    """
+    seeds a synthetic forum and reports latency, query counts and render
+    time per route, failing when a route exceeds its query budget
+    """
+    if database is None:
+        path = os.path.join(tempfile.gettempdir(), 'carafe-bench.sqlite')
+        if os.path.exists(path):
+            os.remove(path)
+        database = 'sqlite:///' + path
+    elif not yes:
+        click.confirm(
+            'Every carafe table in {} will be dropped. Continue?'.format(
+                database), abort=True)
+    current_app.config['SQLALCHEMY_DATABASE_URI'] = database
+    # the benchmark writes far faster than any visitor is allowed to
+    current_app.config['THROTTLE'] = ''
+    current_app.extensions['carafe_throttle'].init_app(current_app)
+    # every panel request must run its queries to be measured
+    current_app.config['ADMIN_STATS_TTL'] = 0
+    current_app.extensions['carafe_admin_stats'].init_app(current_app)
+
+    DB.drop_all()
+    DB.create_all()
+    search_backend().rebuild()
+    DB.session.commit()
+    counts = Importer().load(json.dumps(record) for record in
+                             benchmarks.generate(
+                                 seed, users, boards, posts, comments))
+    click.echo('Seeded {}.'.format(', '.join(
+        '{} {}(s)'.format(count, kind) for kind, count in counts.items())))
+    with OEMBED_PROVIDERS.blocking():
+        _render_all(500)
+    DB.session.remove()
+
+    results = benchmarks.run(
+        current_app, routes or benchmarks.ROUTES, iterations, seed, budgets)
+    click.echo('{:<16}{:>10}{:>10}{:>10}{:>8}{:>8}{:>12}'.format(
+        'route', 'p50 ms', 'p95 ms', 'queries', 'max', 'budget',
+        'render ms'))
+    over = []
+    for stats in results:
+        click.echo('{:<16}{:>10.2f}{:>10.2f}{:>10.1f}{:>8}{:>8}{:>12.2f}'
+                   .format(stats.route, stats.p50, stats.p95, stats.queries,
+                           stats.max_queries, stats.budget or '-',
+                           stats.render))
+        if stats.budget is not None and stats.max_queries > stats.budget:
+            over.append('{} ({} > {})'.format(
+                stats.route, stats.max_queries, stats.budget))
+    if over:
+        raise click.ClickException(
+            'Query budget exceeded: {}'.format(', '.join(over)))
@@ -1,6 +1,7 @@
 """ Carafe Configration """
 import os
 from os import environ
+from carafe import constants
 
 
 def load_config(app):
@@ -24,6 +25,132 @@ def load_config(app):
         app.config['SECRET_KEY'] = environ['SECRET_KEY']
 
     app.config['PORT'] = os.getenv('CARAFE_PORT', 8000)
+    # compile templates and markdown when the application is created
+    app.config['WARMUP'] = os.getenv('CARAFE_WARMUP', 'true') == 'true'
     app.config['REGISTRATION_FLAG'] = os.getenv(
         'CARAFE_REGISTRATION') == 'true'
     app.config['HOST'] = os.getenv('CARAFE_HOST', '0.0.0.0')
+    app.config['PER_PAGE'] = int(
+        os.getenv('CARAFE_PER_PAGE', constants.PER_PAGE))
+    app.config['COMMENTS_PER_PAGE'] = int(
+        os.getenv('CARAFE_COMMENTS_PER_PAGE', constants.COMMENTS_PER_PAGE))
+
+    # local state shared by the workers on a host lives in the instance
+    # folder, which only the application's user may write to
+    os.makedirs(app.instance_path, mode=0o700, exist_ok=True)
+
+    # an empty CARAFE_OEMBED_CACHE keeps the cache in each worker's memory
+    app.config['OEMBED_CACHE_PATH'] = os.getenv(
+        'CARAFE_OEMBED_CACHE',
+        os.path.join(app.instance_path, 'oembed.sqlite'))
+    app.config['OEMBED_CACHE_SIZE'] = int(
+        os.getenv('CARAFE_OEMBED_CACHE_SIZE', 10000))
+    app.config['OEMBED_TTL'] = int(os.getenv('CARAFE_OEMBED_TTL', 86400))
+    app.config['OEMBED_FAILURE_TTL'] = int(
+        os.getenv('CARAFE_OEMBED_FAILURE_TTL', 900))
+    app.config['OEMBED_WORKERS'] = int(os.getenv('CARAFE_OEMBED_WORKERS', 2))
+
+    app.config['COMPRESS_MIN_SIZE'] = int(
+        os.getenv('CARAFE_COMPRESS_MIN_SIZE', 500))
+    app.config['COMPRESS_LEVEL'] = int(os.getenv('CARAFE_COMPRESS_LEVEL', 6))
+    # folder within the static folder that `flask carafe assets` builds to
+    app.config['ASSETS_BUILD'] = os.getenv('CARAFE_ASSETS_BUILD', 'build')
+
+    # anonymous page cache backend: '' (disabled), memory or sqlite
+    app.config['PAGE_CACHE'] = os.getenv('CARAFE_PAGE_CACHE', '')
+    app.config['PAGE_CACHE_PATH'] = os.getenv(
+        'CARAFE_PAGE_CACHE_PATH',
+        os.path.join(app.instance_path, 'pages.sqlite'))
+    app.config['PAGE_CACHE_SIZE'] = int(
+        os.getenv('CARAFE_PAGE_CACHE_SIZE', 2000))
+    app.config['PAGE_CACHE_TTL'] = int(
+        os.getenv('CARAFE_PAGE_CACHE_TTL', 300))
+
+    # write throttling backend: '' (disabled), memory or sqlite, the latter
+    # shared by every worker on a host; rates are REQUESTS/SECONDS allowed
+    # per client address and per signed in user, client addresses only
+    # being throttled once CARAFE_PROXIES below says how to find them
+    app.config['THROTTLE'] = os.getenv('CARAFE_THROTTLE', 'sqlite')
+    app.config['THROTTLE_PATH'] = os.getenv(
+        'CARAFE_THROTTLE_PATH',
+        os.path.join(app.instance_path, 'throttle.sqlite'))
+    app.config['THROTTLE_RATES'] = {
+        'post': os.getenv('CARAFE_THROTTLE_POST', '5/60'),
+        'comment': os.getenv('CARAFE_THROTTLE_COMMENT', '20/60'),
+        'sign_up': os.getenv('CARAFE_THROTTLE_SIGN_UP', '3/3600'),
+        'login': os.getenv('CARAFE_THROTTLE_LOGIN', '10/300'),
+    }
+    # reverse proxies in front of carafe whose X-Forwarded-For is trusted,
+    # 0 when clients connect directly; left unset, carafe cannot tell client
+    # addresses from a proxy's
+    app.config['PROXIES'] = int(os.environ['CARAFE_PROXIES']) \
+        if os.getenv('CARAFE_PROXIES') else None
+
+    app.config['USER_CACHE_TTL'] = int(os.getenv('CARAFE_USER_CACHE_TTL', 60))
+    app.config['USER_CACHE_SIZE'] = int(
+        os.getenv('CARAFE_USER_CACHE_SIZE', 10000))
+
+    app.config['ADMIN_PER_PAGE'] = int(os.getenv('CARAFE_ADMIN_PER_PAGE', 50))
+    app.config['ADMIN_STATS_TTL'] = int(
+        os.getenv('CARAFE_ADMIN_STATS_TTL', 30))
+    app.config['SEARCH_PER_PAGE'] = int(
+        os.getenv('CARAFE_SEARCH_PER_PAGE', 20))
+
+    # an empty CARAFE_METRICS_TOKEN restricts /admin/metrics to admins, an
+    # empty CARAFE_METRICS_PATH keeps metrics in each worker's memory
+    app.config['METRICS_TOKEN'] = os.getenv('CARAFE_METRICS_TOKEN', '')
+    app.config['METRICS_PATH'] = os.getenv(
+        'CARAFE_METRICS_PATH',
+        os.path.join(app.instance_path, 'metrics'))
+    app.config['METRICS_FLUSH_INTERVAL'] = int(
+        os.getenv('CARAFE_METRICS_FLUSH_INTERVAL', 10))
+    # slow requests are logged, 0 disables the log; a non zero profile
+    # interval also samples their stacks every that many milliseconds
+    app.config['SLOW_REQUEST_MS'] = int(
+        os.getenv('CARAFE_SLOW_REQUEST_MS', 1000))
+    app.config['SLOW_REQUEST_PROFILE_MS'] = int(
+        os.getenv('CARAFE_SLOW_REQUEST_PROFILE_MS', 0))
+
+    # background job backend: thread, inline or database, the latter being
+    # run by `flask carafe worker`
+    app.config['JOBS_BACKEND'] = os.getenv('CARAFE_JOBS', 'thread')
+    app.config['JOBS_RETRIES'] = int(os.getenv('CARAFE_JOBS_RETRIES', 3))
+    app.config['JOBS_TIMEOUT'] = int(os.getenv('CARAFE_JOBS_TIMEOUT', 300))
+    app.config['JOBS_WORKERS'] = int(os.getenv('CARAFE_JOBS_WORKERS', 2))
+
+    # live comment streams keep this many undelivered events per reader and
+    # send a keepalive after this many idle seconds
+    app.config['LIVE_BUFFER'] = int(os.getenv('CARAFE_LIVE_BUFFER', 64))
+    app.config['LIVE_HEARTBEAT'] = int(
+        os.getenv('CARAFE_LIVE_HEARTBEAT', 15))
+
+    # connection pooling and statement timeouts (milliseconds, 0 for none)
+    # for postgresql; in pgbouncer mode pooling is left to pgbouncer
+    app.config['DB_POOL_SIZE'] = int(os.getenv('CARAFE_DB_POOL_SIZE', 5))
+    app.config['DB_MAX_OVERFLOW'] = int(
+        os.getenv('CARAFE_DB_MAX_OVERFLOW', 10))
+    app.config['DB_POOL_TIMEOUT'] = int(
+        os.getenv('CARAFE_DB_POOL_TIMEOUT', 30))
+    app.config['DB_POOL_RECYCLE'] = int(
+        os.getenv('CARAFE_DB_POOL_RECYCLE', 1800))
+    app.config['DB_POOL_PRE_PING'] = os.getenv(
+        'CARAFE_DB_POOL_PRE_PING', 'true') == 'true'
+    app.config['DB_STATEMENT_TIMEOUT'] = int(
+        os.getenv('CARAFE_DB_STATEMENT_TIMEOUT', 0))
+    app.config['DB_PGBOUNCER'] = os.getenv('CARAFE_PGBOUNCER') == 'true'
+
+    # read only views read from the replica when one is configured, except
+    # for clients that wrote within the last DB_REPLICA_WINDOW seconds
+    app.config['SQLALCHEMY_BINDS'] = {}
+    if os.getenv('DATABASE_REPLICA_URL'):
+        app.config['SQLALCHEMY_BINDS']['replica'] = \
+            environ['DATABASE_REPLICA_URL']
+    app.config['DB_REPLICA_WINDOW'] = int(
+        os.getenv('CARAFE_DB_REPLICA_WINDOW', 5))
+
+    # soft deleted content moves to the archive tables this many days after
+    # its deletion; archival and board erasure delete this many rows per
+    # transaction
+    app.config['ARCHIVE_AFTER_DAYS'] = int(
+        os.getenv('CARAFE_ARCHIVE_AFTER_DAYS', 30))
+    app.config['DELETE_BATCH'] = int(os.getenv('CARAFE_DELETE_BATCH', 1000))
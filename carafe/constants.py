@@ -11,7 +11,10 @@ DESC_MIN = 4
 DESC_LIMIT = 80
 EMAIL_MIN = 6
 EMAIL_LIMIT = 35
+EXCERPT_LIMIT = 256
+SEARCH_LIMIT = 200
 PER_PAGE = 3
+COMMENTS_PER_PAGE = 50
 
 # JSON API
 RESOURCE_LIMIT = 25
@@ -0,0 +1,127 @@
+""" Carafe Archival """
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import literal, select
+
+from carafe.database.model import (
+    Board, Post, Comment, PostArchive, CommentArchive, DB
+)
+
+POST_COLUMNS = (
+    'pid', 'bid', 'uid', 'date', 'date_edited', 'name', 'text', 'deleted_at')
+COMMENT_COLUMNS = (
+    'cid', 'pid', 'uid', 'date', 'date_edited', 'text', 'deleted',
+    'deleted_at')
+
+
+def _ignore(*_args):
+    pass
+
+
+def _batches(query, key, batch_size):
+    """
+    yields lists of up to batch_size keys from a query until it runs dry;
+    the caller removes each batch before the next is read
+    """
+    while True:
+        keys = [row[0] for row in query.with_entities(key).order_by(
+            key).limit(batch_size)]
+        if not keys:
+            return
+        yield keys
+
+
+def _copy(model, archive, key, keys, columns, archived_at):
+    """
+    copies rows into their archive table and removes them, in the same
+    transaction
+    """
+    DB.session.execute(archive.__table__.insert().from_select(
+        columns + ('archived_at',),
+        select([getattr(model, name) for name in columns] +
+               [literal(archived_at, DB.DateTime)]).where(key.in_(keys))))
+    model.query.filter(key.in_(keys)).delete(synchronize_session=False)
+
+
+def _stamp(model, now):
+    """
+    dates rows deleted before deletion dates were recorded, so they are
+    archived once they are older than the cutoff from now on
+    """
+    return model.query.filter(
+        model.deleted.is_(True), model.deleted_at.is_(None)
+    ).update({model.deleted_at: now}, synchronize_session=False)
+
+
+def archive_deleted(days, batch_size=1000, progress=_ignore):
+    """
+    moves posts and comments deleted more than days ago into the archive
+    tables, a batch per transaction, along with every comment of archived
+    posts; progress is called with the kind and running count after each
+    batch and the counts are returned
+    """
+    now = datetime.now()
+    cutoff = now - timedelta(days=days)
+    _stamp(Post, now)
+    _stamp(Comment, now)
+    DB.session.commit()
+
+    counts = {'post': 0, 'comment': 0}
+    posts = Post.query.filter(
+        Post.deleted.is_(True), Post.deleted_at < cutoff)
+    for pids in _batches(posts, Post.pid, batch_size):
+        thread = Comment.query.filter(Comment.pid.in_(pids))
+        for cids in _batches(thread, Comment.cid, batch_size):
+            _copy(Comment, CommentArchive, Comment.cid, cids,
+                  COMMENT_COLUMNS, now)
+            counts['comment'] += len(cids)
+            DB.session.commit()
+            progress('comment', counts['comment'])
+        _copy(Post, PostArchive, Post.pid, pids, POST_COLUMNS, now)
+        counts['post'] += len(pids)
+        DB.session.commit()
+        progress('post', counts['post'])
+
+    comments = Comment.query.filter(
+        Comment.deleted.is_(True), Comment.deleted_at < cutoff)
+    for cids in _batches(comments, Comment.cid, batch_size):
+        _copy(Comment, CommentArchive, Comment.cid, cids,
+              COMMENT_COLUMNS, now)
+        counts['comment'] += len(cids)
+        DB.session.commit()
+        progress('comment', counts['comment'])
+    return counts
+
+
+def erase_board(bid, batch_size=1000, progress=_ignore):
+    """
+    permanently removes a board with its posts, comments and archived
+    content, deleting a batch per transaction so no lock is held for long;
+    progress is called with the kind and running count after each batch
+    and the counts are returned
+    """
+    counts = {'archived comment': 0, 'comment': 0, 'post': 0,
+              'archived post': 0}
+    # archived comments can belong to live posts as well as archived ones
+    pids = DB.session.query(Post.pid).filter_by(bid=bid).union(
+        DB.session.query(PostArchive.pid).filter_by(bid=bid))
+    steps = (
+        ('archived comment', CommentArchive, CommentArchive.cid,
+         CommentArchive.query.filter(CommentArchive.pid.in_(pids))),
+        ('comment', Comment, Comment.cid, Comment.query.join(
+            Post, Post.pid == Comment.pid).filter(Post.bid == bid)),
+        ('post', Post, Post.pid, Post.query.filter_by(bid=bid)),
+        ('archived post', PostArchive, PostArchive.pid,
+         PostArchive.query.filter_by(bid=bid)),
+    )
+    for kind, model, key, query in steps:
+        for keys in _batches(query, key, batch_size):
+            model.query.filter(key.in_(keys)).delete(
+                synchronize_session=False)
+            counts[kind] += len(keys)
+            DB.session.commit()
+            progress(kind, counts[kind])
+    Board.query.filter_by(bid=bid).delete(synchronize_session=False)
+    DB.session.commit()
+    return counts
@@ -1,29 +1,114 @@
 """ Carafe Database """
 
+import threading
+import time
+from contextlib import contextmanager
+from hashlib import sha256
+
+import markdown as markdown_module
+import pygments
 from flask import Markup
-from markdown import markdown
+from markdown import markdown, Markdown
 from markdown.extensions.codehilite import CodeHiliteExtension
 from markdown.extensions.extra import ExtraExtension
 from micawber import bootstrap_basic, parse_html
-from micawber.cache import Cache as OEmbedCache
 from bs4 import BeautifulSoup
+from sqlalchemy import Column, String, Text
+from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm import deferred
+from carafe.extensions.oembed import OEmbedResolver
+from carafe.signals import CONTENT_RENDERED
+
+OEMBED_PROVIDERS = OEmbedResolver(providers=bootstrap_basic)
+
+# bump whenever the rendering pipeline below changes its output
+RENDERER_VERSION = '1'
+RENDERER_FINGERPRINT = '{}:{}:{}'.format(
+    RENDERER_VERSION, markdown_module.__version__, pygments.__version__)
+
+# Markdown instances are not thread safe, so each render borrows one; a
+# pool rather than a thread local keeps them across gevent's per request
+# greenlets, and the converter built by the warm-up is inherited by workers
+_CONVERTERS = []
+_CONVERTERS_LOCK = threading.Lock()
+
+
+def format_date(date):
+    """ formats a datetime the way carafe displays it """
+    return date.strftime('%b %e %Y at ') + \
+        date.strftime('%I:%M %p').lstrip('0')
+
+
+def content_key(txt):
+    """ keys rendered content by its text and the renderer fingerprint """
+    return sha256(
+        (RENDERER_FINGERPRINT + '\0' + txt).encode('utf-8')).hexdigest()
+
 
-OEMBED_PROVIDERS = bootstrap_basic(OEmbedCache())
+@contextmanager
+def _converter():
+    """ borrows a reset Markdown converter from the pool """
+    with _CONVERTERS_LOCK:
+        converter = _CONVERTERS.pop() if _CONVERTERS else None
+    if converter is None:
+        converter = Markdown(extensions=[
+            CodeHiliteExtension(linenums=True, css_class='highlight'),
+            ExtraExtension()])
+    try:
+        yield converter.reset()
+    finally:
+        with _CONVERTERS_LOCK:
+            _CONVERTERS.append(converter)
+
+
+def render_markdown(txt):
+    """
+    renders user markdown, highlighting code and embedding links, and
+    reports whether every embeddable link was resolved
+    """
+    started = time.perf_counter()
+    with _converter() as converter:
+        mrkdwn_content = converter.convert(txt)
+    with OEMBED_PROVIDERS.track() as pending:
+        oembed_content = parse_html(
+            mrkdwn_content, OEMBED_PROVIDERS, urlize_all=True)
+    CONTENT_RENDERED.send(None, duration=time.perf_counter() - started)
+    return oembed_content, not pending
 
 
 class UserContent:
     """ UserContent class """
+    @declared_attr
+    def rendered_html(cls):
+        # pylint: disable=no-self-argument
+        """ html rendered from the content text """
+        return deferred(Column(Text), group='rendered')
+
+    @declared_attr
+    def rendered_key(cls):
+        # pylint: disable=no-self-argument
+        """ content key of the text that rendered_html was built from """
+        return deferred(Column(String(64)), group='rendered')
+
+    def render(self):
+        """
+        renders the content text and stores the result with the row; renders
+        still waiting on embeds are stored without a key so they are redone
+        """
+        self.rendered_html, complete = render_markdown(self.text)
+        self.rendered_key = content_key(self.text) if complete else None
+
+    @property
+    def is_rendered(self):
+        """ whether the stored html matches the text and renderer """
+        return self.rendered_key == content_key(self.text)
+
     @property
     def html_content(self):
         """ parses markdown content """
-        hil = CodeHiliteExtension(linenums=True, css_class='highlight')
-        extra = ExtraExtension()
-        mrkdwn_content = markdown(self.text, extensions=[hil, extra])
-        oembed_content = parse_html(
-            mrkdwn_content,
-            OEMBED_PROVIDERS,
-            urlize_all=True)
-        return Markup(oembed_content)
+        if self.is_rendered:
+            return Markup(self.rendered_html)
+        return Markup(render_markdown(self.text)[0])
 
     @property
     def clean_text(self):
@@ -33,5 +118,4 @@ class UserContent:
 
     def get_date_str(self):
         """ Carafe Base Object """
-        return self.date.strftime('%b %e %Y at ') + \
-            self.date.strftime('%I:%M %p').lstrip('0')
+        return format_date(self.date)
@@ -1,13 +1,14 @@
 """ Carafe Models """
 
+from collections import namedtuple
 from datetime import datetime
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text
+from sqlalchemy import func, and_, or_
 from carafe.forms import BoardForm, PostForm, CommentForm
-from carafe.database.base import UserContent
+from carafe.database.base import UserContent, format_date
+from carafe.database.routing import RoutingSQLAlchemy
 from carafe import constants
 
-DB = SQLAlchemy()
+DB = RoutingSQLAlchemy()
 
 
 class User(DB.Model):
@@ -40,6 +41,21 @@ class User(DB.Model):
         return self.uid
 
 
+class BoardSummary(namedtuple('BoardSummary', [
+        'board', 'post_count', 'recent_pid', 'recent_name',
+        'recent_username', 'recent_date'])):
+    """
+    index row for a board along with its post count and most recent post
+    """
+    __slots__ = ()
+
+    def get_date_str(self):
+        """
+        gets the display date of the most recent post
+        """
+        return format_date(self.recent_date)
+
+
 class Board(DB.Model):
     """
     Carafe Board class that describes forum boards
@@ -48,25 +64,48 @@ class Board(DB.Model):
     name = DB.Column(DB.String(constants.NAME_LIMIT), unique=True)
     desc = DB.Column(DB.String(constants.DESC_LIMIT))
     deleted = DB.Column(DB.Boolean)
+    erasing = DB.Column(DB.Boolean, default=False)
 
     def __init__(self, name, desc):
         self.name = name
         self.desc = desc
         self.deleted = False
+        self.erasing = False
 
-    def get_recent_post(self):
+    @staticmethod
+    def get_summaries():
         """
-        gets most recent board post
+        gets a BoardSummary for every visible board in a single query
         """
-        return Post.query.filter_by(
-            bid=self.bid).order_by(
-                text('date desc')).first()
+        ranked = DB.session.query(
+            Post.bid.label('bid'),
+            Post.pid.label('pid'),
+            Post.uid.label('uid'),
+            Post.name.label('name'),
+            Post.date.label('date'),
+            func.count(Post.pid).over(
+                partition_by=Post.bid).label('post_count'),
+            func.row_number().over(
+                partition_by=Post.bid,
+                order_by=(Post.date.desc(), Post.pid.desc())).label('rank')
+        ).filter(Post.deleted.is_(False)).subquery()
 
-    def get_post_count(self):
-        """
-        gets the number of posts on a board
-        """
-        return Post.query.filter_by(bid=self.bid).count()
+        rows = DB.session.query(
+            Board,
+            ranked.c.post_count,
+            ranked.c.pid,
+            ranked.c.name,
+            User.username,
+            ranked.c.date
+        ).outerjoin(
+            ranked, and_(ranked.c.bid == Board.bid, ranked.c.rank == 1)
+        ).outerjoin(
+            User, User.uid == ranked.c.uid
+        ).filter(Board.deleted.is_(False)).order_by(Board.bid)
+
+        return [
+            BoardSummary(brd, count or 0, pid, name, username, date)
+            for brd, count, pid, name, username, date in rows]
 
     def get_edit_form(self):
         """
@@ -77,17 +116,12 @@ class Board(DB.Model):
         form.desc.data = self.desc
         return form
 
-    def get_username(self):
-        """
-        board method to get username
-        """
-        return User.query.get(self.uid).username
-
 
 class Post(DB.Model, UserContent):
     """
     Carafe Post class that describes board posts
     """
+
     pid = DB.Column(DB.Integer, primary_key=True)
     bid = DB.Column(DB.Integer, DB.ForeignKey(Board.bid, ondelete='CASCADE'))
     uid = DB.Column(DB.Integer, DB.ForeignKey(User.uid, ondelete='CASCADE'))
@@ -95,44 +129,99 @@ class Post(DB.Model, UserContent):
     date_edited = DB.Column(DB.DateTime, index=True)
     name = DB.Column(DB.String(constants.NAME_LIMIT))
     text = DB.Column(DB.String(constants.TEXT_LIMIT))
+    excerpt = DB.Column(DB.String(constants.EXCERPT_LIMIT))
     deleted = DB.Column(DB.Boolean)
+    deleted_at = DB.Column(DB.DateTime)
+    comment_count = DB.Column(DB.Integer, default=0)
+    last_comment_at = DB.Column(DB.DateTime)
+    # the board listing's keyset cursor, which cannot hold a null
+    last_activity_at = DB.Column(DB.DateTime, nullable=False)
+    author = DB.relationship(User, lazy='select')
 
     def __init__(self, bid, uid, name, txt):
         self.bid = bid
         self.uid = uid
         self.date = datetime.now()
         self.date_edited = self.date
+        self.comment_count = 0
+        self.last_comment_at = None
+        self.last_activity_at = self.date
         self.name = name
         self.text = txt
         self.deleted = False
 
+    def render(self):
+        """
+        renders the post along with the plain text excerpt used by listings
+        """
+        super().render()
+        self.excerpt = self.clean_text[:constants.EXCERPT_LIMIT]
+
+    @property
+    def is_rendered(self):
+        """
+        whether the stored html and excerpt are up to date
+        """
+        return self.excerpt is not None and super().is_rendered
+
+    @staticmethod
+    def record_comment(pid, date):
+        """
+        counts a newly created comment against its post
+        """
+        Post.query.filter_by(pid=pid).update({
+            Post.comment_count: Post.comment_count + 1,
+            Post.last_comment_at: date,
+            Post.last_activity_at: date
+        }, synchronize_session=False)
+
+    @staticmethod
+    def refresh_activity(pid=None):
+        """
+        recomputes the comment counters of a post, or of every post when no
+        pid is provided, returning the number of posts that were repaired
+        """
+        comments = DB.session.query(Comment).filter(
+            Comment.pid == Post.pid,
+            Comment.deleted.is_(False)).correlate(Post)
+        count = comments.with_entities(func.count(Comment.cid)).as_scalar()
+        latest = comments.with_entities(func.max(Comment.date)).as_scalar()
+        values = {
+            Post.comment_count: count,
+            Post.last_comment_at: latest,
+            Post.last_activity_at: func.coalesce(latest, Post.date)
+        }
+
+        query = Post.query
+        if pid is not None:
+            # lock the post first so the counts below see concurrent writers
+            DB.session.query(Post.pid).filter_by(
+                pid=pid).with_for_update().scalar()
+            query = query.filter_by(pid=pid)
+        return query.filter(or_(*[
+            column.is_distinct_from(value)
+            for column, value in values.items()
+        ])).update(values, synchronize_session=False)
+
     def get_comment_count(self):
         """
         get total comment count on post
         """
-        return Comment.query.filter_by(pid=self.pid).count()
+        return self.comment_count
 
     def get_latest_comment_info(self):
         """
         get the latest comment info on the post
         """
-        comment = Comment.query.filter_by(
-            pid=self.pid).order_by(
-                text("date desc")).first()
-        if comment:
-            return comment.get_date_str()
+        if self.last_comment_at:
+            return format_date(self.last_comment_at)
         return 'None'
 
     def recent_date(self):
         """
         get most recent comment date or post date
         """
-        comment = Comment.query.filter_by(
-            pid=self.pid).order_by(
-                text("date desc")).first()
-        if comment:
-            return comment.date
-        return self.date
+        return self.last_activity_at or self.date
 
     def get_edit_form(self):
         """
@@ -147,13 +236,19 @@ class Post(DB.Model, UserContent):
         """
         post helper to get username by id
         """
-        return User.query.get(self.uid).username
+        return self.author.username
 
 
 class Comment(DB.Model, UserContent):
     """
     Carafe Comment class that describes post comments
     """
+    # threads show deleted comments as removed, so the thread index covers
+    # every comment of a post in display order
+    __table_args__ = (
+        DB.Index('ix_comment_pid_date', 'pid', 'date', 'cid'),
+    )
+
     cid = DB.Column(DB.Integer, primary_key=True)
     pid = DB.Column(DB.Integer, DB.ForeignKey(Post.pid, ondelete='CASCADE'))
     uid = DB.Column(DB.Integer, DB.ForeignKey(User.uid, ondelete='CASCADE'))
@@ -161,6 +256,8 @@ class Comment(DB.Model, UserContent):
     date_edited = DB.Column(DB.DateTime, index=True)
     text = DB.Column(DB.String(constants.TEXT_LIMIT))
     deleted = DB.Column(DB.Boolean)
+    deleted_at = DB.Column(DB.DateTime)
+    author = DB.relationship(User, lazy='select')
 
     def __init__(self, pid, uid, txt):
         self.pid = pid
@@ -182,4 +279,94 @@ class Comment(DB.Model, UserContent):
         """
         comment method to get username
         """
-        return User.query.get(self.uid).username
+        return self.author.username
+
+
+def _partial_index(name, where, *columns):
+    """
+    indexes only the rows matching where, on databases that support it
+    """
+    return DB.Index(
+        name, *columns, postgresql_where=where, sqlite_where=where)
+
+
+# listings only read live rows and archival only scans deleted ones, so
+# neither pays for indexing the other; queries must use the same literal
+# predicate for the planner to match them
+_partial_index(
+    'ix_post_bid_activity', Post.deleted.is_(False),
+    Post.bid, Post.last_activity_at, Post.pid)
+_partial_index(
+    'ix_post_bid_date_live', Post.deleted.is_(False),
+    Post.bid, Post.date, Post.pid)
+_partial_index(
+    'ix_post_deleted_at', Post.deleted.is_(True), Post.deleted_at)
+_partial_index(
+    'ix_comment_deleted_at', Comment.deleted.is_(True), Comment.deleted_at)
+
+
+class PostArchive(DB.Model):
+    """
+    Carafe PostArchive class that keeps posts removed from the post table
+    """
+    pid = DB.Column(DB.Integer, primary_key=True, autoincrement=False)
+    bid = DB.Column(DB.Integer, index=True)
+    uid = DB.Column(DB.Integer)
+    date = DB.Column(DB.DateTime)
+    date_edited = DB.Column(DB.DateTime)
+    name = DB.Column(DB.String(constants.NAME_LIMIT))
+    text = DB.Column(DB.String(constants.TEXT_LIMIT))
+    deleted_at = DB.Column(DB.DateTime)
+    archived_at = DB.Column(DB.DateTime)
+
+
+class CommentArchive(DB.Model):
+    """
+    Carafe CommentArchive class that keeps comments removed from the comment
+    table
+    """
+    cid = DB.Column(DB.Integer, primary_key=True, autoincrement=False)
+    pid = DB.Column(DB.Integer, index=True)
+    uid = DB.Column(DB.Integer)
+    date = DB.Column(DB.DateTime)
+    date_edited = DB.Column(DB.DateTime)
+    text = DB.Column(DB.String(constants.TEXT_LIMIT))
+    deleted = DB.Column(DB.Boolean)
+    deleted_at = DB.Column(DB.DateTime)
+    archived_at = DB.Column(DB.DateTime)
+
+
+class Job(DB.Model):
+    """
+    Carafe Job class that describes queued background work
+    """
+    __table_args__ = (DB.Index('ix_job_state_run_at', 'state', 'run_at'),)
+
+    jid = DB.Column(DB.Integer, primary_key=True)
+    task = DB.Column(DB.String(64))
+    args = DB.Column(DB.Text)
+    state = DB.Column(DB.String(16))
+    attempts = DB.Column(DB.Integer)
+    run_at = DB.Column(DB.DateTime)
+    locked_at = DB.Column(DB.DateTime)
+    error = DB.Column(DB.Text)
+
+    def __init__(self, task, args):
+        self.task = task
+        self.args = args
+        self.state = 'queued'
+        self.attempts = 0
+        self.run_at = datetime.now()
+
+
+class ImportCheckpoint(DB.Model):
+    """
+    Carafe ImportCheckpoint class that records how far a named import got,
+    written in the same transaction as each batch it imports
+    """
+    name = DB.Column(DB.String(255), primary_key=True)
+    state = DB.Column(DB.Text)
+
+    def __init__(self, name, state):
+        self.name = name
+        self.state = state
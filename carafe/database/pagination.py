@@ -0,0 +1,115 @@
+""" Carafe Pagination """
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from sqlalchemy import tuple_
+
+
+class Page:
+    """
+    a single page of keyset paginated results along with the cursors that
+    lead to its neighbouring pages
+    """
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(values):
+    """
+    encodes the key values of a row into an opaque url safe cursor
+    """
+    values = [
+        value.isoformat() if isinstance(value, datetime) else value
+        for value in values]
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _coerce(value, python_type):
+    """
+    converts a decoded cursor value to the python type of its key, raising
+    TypeError when it is not one
+    """
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    if isinstance(value, bool) and python_type is not bool:
+        raise TypeError('unexpected boolean')
+    if python_type is float and isinstance(value, int):
+        return float(value)
+    if not isinstance(value, python_type):
+        raise TypeError('expected {}'.format(python_type.__name__))
+    return value
+
+
+def decode_cursor(cursor, columns=None, types=None):
+    """
+    decodes a cursor produced by encode_cursor for the provided key columns,
+    or python types when the keys are not columns, returning None if the
+    cursor is malformed or holds values of the wrong type
+    """
+    try:
+        if types is None:
+            types = [column.type.python_type for column in columns]
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(urlsafe_b64decode(padded.encode('ascii')))
+        if not isinstance(values, list) or len(values) != len(types):
+            return None
+        return tuple(
+            _coerce(value, python_type)
+            for value, python_type in zip(values, types))
+    except (ValueError, TypeError, NotImplementedError):
+        return None
+
+
+def paginate(query, columns, after=None, before=None, per_page=25,
+             descending=True, key=None, from_end=False):
+    """
+    keyset paginates a query over the provided unique column tuple without
+    using OFFSET; after and before are cursors taken from a previous Page,
+    without either from_end requests the final page
+    """
+    key = key or (
+        lambda item: tuple(getattr(item, column.key) for column in columns))
+    after = decode_cursor(after, columns) if after else None
+    before = decode_cursor(before, columns) if before else None
+    backward = (before is not None or from_end) and after is None
+    cursor = before if backward else after
+    keys = tuple_(*columns)
+
+    # walking backwards flips both the comparison and the sort order, the
+    # rows are then reversed so the page always reads in display order
+    ascending = descending == backward
+    if cursor is not None:
+        query = query.filter(keys > cursor if ascending else keys < cursor)
+    query = query.order_by(*[
+        column.asc() if ascending else column.desc() for column in columns])
+
+    items = query.limit(per_page + 1).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if backward:
+        items.reverse()
+
+    if not items:
+        return Page(items)
+
+    first, last = encode_cursor(key(items[0])), encode_cursor(key(items[-1]))
+    if backward:
+        return Page(
+            items,
+            next_cursor=last if cursor is not None else None,
+            prev_cursor=first if has_more else None)
+    return Page(
+        items,
+        next_cursor=last if has_more else None,
+        prev_cursor=first if cursor is not None else None)
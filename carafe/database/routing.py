@@ -0,0 +1,152 @@
+""" Carafe Database Routing """
+
+import os
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from flask import session as http_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc, orm
+from sqlalchemy.engine import create_engine
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql.expression import UpdateBase
+
+REPLICA_BIND = 'replica'
+# the flask session key holding when a client may read from the replica
+# again after writing
+REPLICA_AFTER = '_replica_after'
+
+
+def use_replica():
+    """
+    lets reads made by the current GET request go to the replica
+    """
+    if request.method in ('GET', 'HEAD'):
+        g.carafe_replica = True
+
+
+def replica_reads(view):
+    """
+    decorator for read only views whose queries may be served by the replica
+    """
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        use_replica()
+        return view(*args, **kwargs)
+    return decorated
+
+
+def _replica_allowed():
+    """
+    whether the current request may read from the replica, which is not the
+    case for a while after its client wrote so it reads its own writes
+    """
+    if not has_request_context() or not g.get('carafe_replica'):
+        return False
+    return http_session.get(REPLICA_AFTER, 0) <= time.time()
+
+
+class RoutingSession(SignallingSession):
+    """
+    session that sends the reads of requests marked for the replica to the
+    replica bind and everything else to the primary
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if REPLICA_BIND in (self.app.config['SQLALCHEMY_BINDS'] or {}) and \
+                not self._flushing and \
+                not isinstance(clause, UpdateBase) and _replica_allowed():
+            return self.db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _wrote(session, _context):
+    session.info['carafe_wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_bulk_update')
+@event.listens_for(RoutingSession, 'after_bulk_delete')
+def _bulk_wrote(update_context):
+    update_context.session.info['carafe_wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _committed(session):
+    if session.info.pop('carafe_wrote', False) and has_request_context():
+        http_session[REPLICA_AFTER] = \
+            time.time() + current_app.config['DB_REPLICA_WINDOW']
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _rolled_back(session):
+    session.info.pop('carafe_wrote', None)
+
+
+def _guard_fork(engine):
+    """
+    keeps a forked process from using connections its parent opened, which
+    would interleave both on one socket; they are dropped without being
+    closed since closing them would end the parent's session as well
+    """
+    @event.listens_for(engine, 'connect')
+    def _connected(_dbapi_connection, record):
+        record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def _checked_out(_dbapi_connection, record, proxy):
+        if record.info.get('pid') != os.getpid():
+            record.connection = proxy.connection = None
+            raise exc.DisconnectionError(
+                'connection belongs to process {}'.format(
+                    record.info.get('pid')))
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    flask-sqlalchemy with pool and timeout settings taken from the
+    application config, read replica routing and fork safe engines
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+        if not sa_url.drivername.startswith('postgresql'):
+            return
+        timeout = app.config['DB_STATEMENT_TIMEOUT']
+        if app.config['DB_PGBOUNCER']:
+            # pgbouncer pools the connections, so each checkout connects
+            # afresh and nothing may outlive a transaction: no session
+            # settings, startup options or per connection type lookups
+            options['poolclass'] = NullPool
+            options['use_native_hstore'] = False
+            if timeout:
+                options['carafe_local_timeout'] = timeout
+            return
+        options.update(
+            pool_size=app.config['DB_POOL_SIZE'],
+            max_overflow=app.config['DB_MAX_OVERFLOW'],
+            pool_timeout=app.config['DB_POOL_TIMEOUT'],
+            pool_recycle=app.config['DB_POOL_RECYCLE'],
+            pool_pre_ping=app.config['DB_POOL_PRE_PING'])
+        if timeout:
+            options.setdefault('connect_args', {})['options'] = \
+                '-c statement_timeout={}'.format(timeout)
+
+    def create_engine(self, sa_url, engine_opts):
+        timeout = engine_opts.pop('carafe_local_timeout', None)
+        engine = create_engine(sa_url, **engine_opts)
+        _guard_fork(engine)
+        if timeout:
+            @event.listens_for(engine, 'begin')
+            def _local_timeout(connection):
+                connection.execute(
+                    'SET LOCAL statement_timeout = {:d}'.format(timeout))
+        return engine
@@ -0,0 +1,232 @@
+""" Carafe Search """
+
+import re
+from collections import namedtuple
+
+from flask import Markup, escape
+from sqlalchemy import DateTime, text
+
+from carafe.database.model import DB
+from carafe.database.pagination import Page, decode_cursor, encode_cursor
+
+# highlight markers that cannot appear in user text, swapped for <mark> tags
+# once the snippet has been escaped
+MARK_START, MARK_STOP = '\x02', '\x03'
+WORDS = re.compile(r'\w+', re.UNICODE)
+
+SearchHit = namedtuple('SearchHit', [
+    'pid', 'bid', 'cid', 'title', 'snippet', 'date'])
+
+
+def _highlight(snippet):
+    """
+    escapes a snippet and turns its highlight markers into mark tags
+    """
+    return Markup(str(escape(snippet)).replace(
+        MARK_START, '<mark>').replace(MARK_STOP, '</mark>'))
+
+
+class SqliteSearch:
+    """
+    search backend built on an sqlite fts5 index that triggers keep in sync
+    with posts and comments; documents are keyed by rowid, posts taking even
+    rowids (pid * 2) and comments odd ones (cid * 2 + 1)
+    """
+    INSTALL = (
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+        "title, body, tokenize = 'porter unicode61')",
+        "CREATE TRIGGER IF NOT EXISTS post_search_insert AFTER INSERT ON post "
+        "BEGIN INSERT INTO search_index (rowid, title, body) "
+        "VALUES (new.pid * 2, new.name, new.text); END",
+        "CREATE TRIGGER IF NOT EXISTS post_search_update "
+        "AFTER UPDATE OF name, text ON post "
+        "BEGIN UPDATE search_index SET title = new.name, body = new.text "
+        "WHERE rowid = new.pid * 2; END",
+        "CREATE TRIGGER IF NOT EXISTS post_search_delete AFTER DELETE ON post "
+        "BEGIN DELETE FROM search_index WHERE rowid = old.pid * 2; END",
+        "CREATE TRIGGER IF NOT EXISTS comment_search_insert "
+        "AFTER INSERT ON comment "
+        "BEGIN INSERT INTO search_index (rowid, title, body) "
+        "VALUES (new.cid * 2 + 1, '', new.text); END",
+        "CREATE TRIGGER IF NOT EXISTS comment_search_update "
+        "AFTER UPDATE OF text ON comment "
+        "BEGIN UPDATE search_index SET body = new.text "
+        "WHERE rowid = new.cid * 2 + 1; END",
+        "CREATE TRIGGER IF NOT EXISTS comment_search_delete "
+        "AFTER DELETE ON comment "
+        "BEGIN DELETE FROM search_index WHERE rowid = old.cid * 2 + 1; END",
+    )
+    REBUILD = (
+        "DELETE FROM search_index",
+        "INSERT INTO search_index (rowid, title, body) "
+        "SELECT pid * 2, name, text FROM post",
+        "INSERT INTO search_index (rowid, title, body) "
+        "SELECT cid * 2 + 1, '', text FROM comment",
+    )
+    SEARCH = text(
+        "SELECT hit.rowid AS doc, hit.rank AS rank, post.pid AS pid, "
+        "post.bid AS bid, comment.cid AS cid, post.name AS title, "
+        "coalesce(comment.date, post.date) AS date "
+        "FROM (SELECT rowid, bm25(search_index, 4.0, 1.0) AS rank "
+        "FROM search_index WHERE search_index MATCH :query) AS hit "
+        "LEFT JOIN comment ON hit.rowid % 2 = 1 "
+        "AND comment.cid = hit.rowid / 2 "
+        "JOIN post ON post.pid = coalesce(comment.pid, hit.rowid / 2) "
+        "AND (hit.rowid % 2 = 0 OR comment.cid IS NOT NULL) "
+        "JOIN board ON board.bid = post.bid "
+        "WHERE post.deleted = 0 AND board.deleted = 0 "
+        "AND (comment.cid IS NULL OR comment.deleted = 0) "
+        "AND (:rank IS NULL OR hit.rank > :rank "
+        "OR (hit.rank = :rank AND hit.rowid > :doc)) "
+        "ORDER BY hit.rank, hit.rowid LIMIT :limit").columns(date=DateTime)
+    SNIPPETS = (
+        "SELECT rowid, snippet(search_index, -1, :start, :stop, '...', 24) "
+        "FROM search_index WHERE search_index MATCH :query "
+        "AND rowid IN ({})")
+
+    def install(self):
+        """
+        creates the fts index and its triggers
+        """
+        for statement in self.INSTALL:
+            DB.session.execute(text(statement))
+
+    def rebuild(self):
+        """
+        reindexes every post and comment
+        """
+        self.install()
+        for statement in self.REBUILD:
+            DB.session.execute(text(statement))
+
+    @staticmethod
+    def query(terms):
+        """
+        turns free text into an fts5 query matching every word
+        """
+        return ' '.join('"{}"'.format(word) for word in WORDS.findall(terms))
+
+    def search(self, terms, cursor, limit):
+        """
+        gets matching rows ranked best first along with their keys
+        """
+        query = self.query(terms)
+        if not query:
+            return []
+        rank, doc = cursor or (None, None)
+        rows = DB.session.execute(self.SEARCH, {
+            'query': query, 'rank': rank, 'doc': doc, 'limit': limit
+        }).fetchall()
+        if not rows:
+            return rows
+
+        docs = [int(row.doc) for row in rows]
+        snippets = dict(DB.session.execute(
+            text(self.SNIPPETS.format(','.join(str(d) for d in docs))),
+            {'query': query, 'start': MARK_START, 'stop': MARK_STOP}
+        ).fetchall())
+        return [
+            ((row.rank, row.doc), SearchHit(
+                row.pid, row.bid, row.cid, row.title,
+                _highlight(snippets.get(row.doc, '')), row.date))
+            for row in rows]
+
+
+class PostgresSearch:
+    """
+    search backend built on generated tsvector columns with gin indexes
+    that only cover live rows
+    """
+    INSTALL = (
+        "ALTER TABLE post ADD COLUMN IF NOT EXISTS search_vector tsvector "
+        "GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(text, '')), 'B')) STORED",
+        "CREATE INDEX IF NOT EXISTS ix_post_search ON post "
+        "USING gin (search_vector) WHERE deleted = false",
+        "ALTER TABLE comment ADD COLUMN IF NOT EXISTS search_vector tsvector "
+        "GENERATED ALWAYS AS ("
+        "to_tsvector('english', coalesce(text, ''))) STORED",
+        "CREATE INDEX IF NOT EXISTS ix_comment_search ON comment "
+        "USING gin (search_vector) WHERE deleted = false",
+    )
+    SEARCH = text(
+        "WITH q AS (SELECT websearch_to_tsquery('english', :query) AS query) "
+        "SELECT hits.doc, hits.rank, hits.pid, hits.bid, hits.cid, "
+        "hits.title, hits.date, ts_headline('english', hits.body, q.query, "
+        "'StartSel=' || :start || ', StopSel=' || :stop || "
+        "', MaxWords=35, MinWords=15, MaxFragments=1') AS snippet "
+        "FROM (SELECT * FROM ("
+        "SELECT post.pid * 2 AS doc, post.pid, post.bid, NULL AS cid, "
+        "post.name AS title, post.text AS body, post.date, "
+        "ts_rank(post.search_vector, q.query) AS rank "
+        "FROM post JOIN board ON board.bid = post.bid, q "
+        "WHERE post.search_vector @@ q.query AND post.deleted = false "
+        "AND board.deleted = false "
+        "UNION ALL "
+        "SELECT comment.cid * 2 + 1, post.pid, post.bid, comment.cid, "
+        "post.name, comment.text, comment.date, "
+        "ts_rank(comment.search_vector, q.query) "
+        "FROM comment JOIN post ON post.pid = comment.pid "
+        "JOIN board ON board.bid = post.bid, q "
+        "WHERE comment.search_vector @@ q.query AND comment.deleted = false "
+        "AND post.deleted = false AND board.deleted = false"
+        ") AS matches "
+        "WHERE CAST(:rank AS real) IS NULL OR matches.rank < :rank "
+        "OR (matches.rank = :rank AND matches.doc > :doc) "
+        "ORDER BY matches.rank DESC, matches.doc LIMIT :limit) AS hits, q "
+        "ORDER BY hits.rank DESC, hits.doc").columns(date=DateTime)
+
+    def install(self):
+        """
+        adds the generated search columns and their indexes
+        """
+        for statement in self.INSTALL:
+            DB.session.execute(text(statement))
+
+    def rebuild(self):
+        """
+        generated columns are always current, so this only installs them
+        """
+        self.install()
+
+    def search(self, terms, cursor, limit):
+        """
+        gets matching rows ranked best first along with their keys
+        """
+        if not WORDS.search(terms):
+            return []
+        rank, doc = cursor or (None, None)
+        rows = DB.session.execute(self.SEARCH, {
+            'query': terms, 'rank': rank, 'doc': doc, 'limit': limit,
+            'start': MARK_START, 'stop': MARK_STOP
+        }).fetchall()
+        return [
+            ((row.rank, row.doc), SearchHit(
+                row.pid, row.bid, row.cid, row.title,
+                _highlight(row.snippet), row.date))
+            for row in rows]
+
+
+def search_backend():
+    """
+    gets the search backend for the configured database
+    """
+    if DB.engine.dialect.name == 'postgresql':
+        return PostgresSearch()
+    return SqliteSearch()
+
+
+def search(terms, after=None, per_page=25):
+    """
+    full text searches live posts and comments, returning a Page of
+    SearchHits with highlighted snippets ranked best first
+    """
+    # the cursor holds the rank and document key of the last hit
+    cursor = decode_cursor(after, types=(float, int)) if after else None
+    results = search_backend().search(terms, cursor, per_page + 1)
+    has_more = len(results) > per_page
+    results = results[:per_page]
+    return Page(
+        [hit for _, hit in results],
+        next_cursor=encode_cursor(results[-1][0]) if has_more else None)
@@ -0,0 +1,136 @@
+""" Carafe Admin Statistics """
+
+from collections import namedtuple
+
+from sqlalchemy import case, func
+
+from carafe.database.model import Board, Post, Comment, User, DB
+from carafe.database.pagination import paginate
+from carafe.extensions.cache import MemoryCache
+
+BoardStats = namedtuple('BoardStats', [
+    'bid', 'name', 'deleted', 'erasing', 'posts', 'deleted_posts', 'comments',
+    'deleted_comments'])
+UserStats = namedtuple('UserStats', [
+    'uid', 'username', 'is_admin', 'posts', 'comments'])
+Totals = namedtuple('Totals', ['live', 'deleted'])
+
+
+def _split_deleted(column):
+    """
+    counts rows with the deleted flag unset and set as two columns
+    """
+    return (
+        func.coalesce(func.sum(case([(column.is_(True), 0)], else_=1)), 0),
+        func.coalesce(func.sum(case([(column.is_(True), 1)], else_=0)), 0))
+
+
+def _counts_by_board(query, bids):
+    """
+    groups a query of live and deleted counts by board, for the provided
+    boards only
+    """
+    if not bids:
+        return {}
+    return {
+        bid: (int(live), int(deleted))
+        for bid, live, deleted in query.filter(
+            Post.bid.in_(bids)).group_by(Post.bid)}
+
+
+class AdminStats:
+    """
+    aggregate statistics for the admin panel computed with grouped queries
+    and cached briefly
+    """
+
+    def __init__(self):
+        self._cache = MemoryCache(max_entries=256, default_ttl=30)
+
+    def init_app(self, app):
+        """
+        configures how long statistics are cached, an ADMIN_STATS_TTL of 0
+        disabling the cache
+        """
+        app.extensions['carafe_admin_stats'] = self
+        ttl = app.config['ADMIN_STATS_TTL']
+        self._cache = MemoryCache(
+            max_entries=256, default_ttl=ttl) if ttl else None
+
+    def _cached(self, key, compute):
+        if self._cache is None:
+            return compute()
+        value = self._cache.get(key)
+        if value is None:
+            value = compute()
+            self._cache.set(key, value)
+        return value
+
+    def totals(self):
+        """
+        gets live and deleted totals of boards, posts and comments along
+        with the number of users
+        """
+        def compute():
+            totals = {}
+            for name, model in (
+                    ('boards', Board), ('posts', Post),
+                    ('comments', Comment)):
+                live, deleted = DB.session.query(
+                    *_split_deleted(model.deleted)).one()
+                totals[name] = Totals(int(live), int(deleted))
+            totals['users'] = DB.session.query(func.count(User.uid)).scalar()
+            return totals
+        return self._cached('totals', compute)
+
+    def boards(self, after=None, before=None, per_page=25):
+        """
+        gets a keyset paginated page of per board post and comment counts;
+        the boards are picked first so only their rows are counted
+        """
+        def compute():
+            page = paginate(
+                DB.session.query(
+                    Board.bid.label('bid'), Board.name, Board.deleted,
+                    Board.erasing.is_(True)),
+                (Board.bid,), after=after, before=before,
+                per_page=per_page, descending=False)
+            bids = [row.bid for row in page.items]
+            posts = _counts_by_board(DB.session.query(
+                Post.bid, *_split_deleted(Post.deleted)), bids)
+            comments = _counts_by_board(DB.session.query(
+                Post.bid, *_split_deleted(Comment.deleted)
+            ).join(Comment, Comment.pid == Post.pid), bids)
+            page.items = [
+                BoardStats(*row, *posts.get(row.bid, (0, 0)),
+                           *comments.get(row.bid, (0, 0)))
+                for row in page.items]
+            return page
+        return self._cached(
+            'boards:{}:{}:{}'.format(after, before, per_page), compute)
+
+    def top_users(self, limit=10):
+        """
+        gets the most active users by number of posts and comments
+        """
+        def compute():
+            posts = DB.session.query(
+                Post.uid.label('uid'),
+                func.count(Post.pid).label('count')
+            ).group_by(Post.uid).subquery()
+            comments = DB.session.query(
+                Comment.uid.label('uid'),
+                func.count(Comment.cid).label('count')
+            ).group_by(Comment.uid).subquery()
+            post_count = func.coalesce(posts.c.count, 0)
+            comment_count = func.coalesce(comments.c.count, 0)
+            rows = DB.session.query(
+                User.uid, User.username, User.is_admin, post_count,
+                comment_count
+            ).outerjoin(posts, posts.c.uid == User.uid).outerjoin(
+                comments, comments.c.uid == User.uid
+            ).order_by(
+                (post_count + comment_count).desc(), User.uid
+            ).limit(limit)
+            return [UserStats(*row) for row in rows]
+        return self._cached('users:{}'.format(limit), compute)
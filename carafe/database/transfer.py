@@ -0,0 +1,247 @@
+""" Carafe Bulk Transfer """
+
+import io
+import json
+from datetime import datetime
+
+from sqlalchemy import DateTime, func
+
+from carafe.database.model import (
+    User, Board, Post, Comment, ImportCheckpoint, DB
+)
+
+# models in dependency order along with the columns that are transferred,
+# derived columns such as renders and counters are rebuilt after import
+TRANSFER = (
+    ('user', User, User.uid, (
+        'uid', 'username', 'email', 'password', 'is_active', 'is_anonymous',
+        'is_authenticated', 'is_confirmed', 'is_admin')),
+    ('board', Board, Board.bid, ('bid', 'name', 'desc', 'deleted')),
+    ('post', Post, Post.pid, (
+        'pid', 'bid', 'uid', 'date', 'date_edited', 'name', 'text',
+        'deleted', 'deleted_at')),
+    ('comment', Comment, Comment.cid, (
+        'cid', 'pid', 'uid', 'date', 'date_edited', 'text', 'deleted',
+        'deleted_at')),
+)
+
+
+def export_jsonl(stream, batch_size=5000):
+    """
+    writes users, boards, posts and comments to a stream as json lines,
+    walking each table in primary key batches so memory use stays flat
+    """
+    counts = {}
+    for kind, model, key, columns in TRANSFER:
+        counts[kind], last = 0, None
+        fields = [getattr(model, column) for column in columns]
+        while True:
+            query = DB.session.query(*fields).order_by(key)
+            if last is not None:
+                query = query.filter(key > last)
+            rows = query.limit(batch_size).all()
+            if not rows:
+                break
+            for row in rows:
+                record = {'type': kind}
+                for column, value in zip(columns, row):
+                    record[column] = value.isoformat() \
+                        if isinstance(value, datetime) else value
+                stream.write(json.dumps(record) + '\n')
+            counts[kind] += len(rows)
+            last = getattr(rows[-1], key.key)
+        DB.session.rollback()
+    return counts
+
+
+class Importer:
+    """
+    loads an export produced by export_jsonl in large batches; imported ids
+    are shifted past the ids already in use, users and boards whose names
+    already exist are merged into the existing rows, and progress is
+    checkpointed under a name in the transaction of every batch, so an
+    interrupted import resumes exactly after the last committed batch
+    """
+
+    def __init__(self, checkpoint=None, batch_size=5000):
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.state = self._load_checkpoint()
+        self.columns = {
+            kind: (model, columns) for kind, model, _, columns in TRANSFER}
+
+    def _load_checkpoint(self):
+        saved = ImportCheckpoint.query.get(self.checkpoint) \
+            if self.checkpoint else None
+        if saved is not None:
+            return json.loads(saved.state)
+        offsets = {}
+        for kind, _, key, _ in TRANSFER:
+            offsets[kind] = DB.session.query(func.max(key)).scalar() or 0
+        return {'line': 0, 'offsets': offsets, 'user': {}, 'board': {}}
+
+    def _save_checkpoint(self):
+        if self.checkpoint:
+            DB.session.merge(
+                ImportCheckpoint(self.checkpoint, json.dumps(self.state)))
+
+    def _remap(self, kind, old):
+        """
+        maps an exported id onto the id it was imported as
+        """
+        if old is None:
+            return None
+        merged = self.state.get(kind, {}).get(str(old))
+        return merged if merged is not None else \
+            old + self.state['offsets'][kind]
+
+    def _merge_existing(self, kind, records):
+        """
+        drops users and boards that already exist by name, or users that
+        exist by email, remembering the existing id so their posts and
+        comments attach to it; names are matched exactly, as they are only
+        unique exactly, so every record is either kept or mapped
+        """
+        if kind == 'user':
+            column, field, key = User.username, 'username', User.uid
+        else:
+            column, field, key = Board.name, 'name', Board.bid
+        existing = dict(DB.session.query(column, key).filter(
+            column.in_([record[field] for record in records])))
+        emails = {}
+        if kind == 'user':
+            emails = dict(DB.session.query(
+                func.lower(User.email), User.uid).filter(
+                    func.lower(User.email).in_(
+                        [record['email'].lower() for record in records])))
+
+        kept = []
+        for record in records:
+            old = record[self.columns[kind][1][0]]
+            merged = existing.get(record[field])
+            if merged is None and kind == 'user':
+                merged = emails.get(record['email'].lower())
+            if merged is not None:
+                self.state[kind][str(old)] = merged
+            else:
+                kept.append(record)
+        return kept
+
+    def _prepare(self, kind, record):
+        """
+        converts a record into a row of the target table
+        """
+        model, columns = self.columns[kind]
+        row = {}
+        for column in columns:
+            value = record.get(column)
+            if value is not None and \
+                    isinstance(getattr(model, column).type, DateTime):
+                value = datetime.fromisoformat(value)
+            row[column] = value
+        row[columns[0]] = self._remap(kind, record[columns[0]])
+        for parent in ('bid', 'uid', 'pid'):
+            if parent in row and parent != columns[0]:
+                row[parent] = self._remap(
+                    {'bid': 'board', 'uid': 'user', 'pid': 'post'}[parent],
+                    record[parent])
+        if kind == 'post':
+            row['last_activity_at'] = row['date']
+        return row
+
+    def _insert(self, kind, rows):
+        """
+        inserts rows with postgresql COPY when available, falling back to
+        a chunked executemany
+        """
+        model = self.columns[kind][0]
+        if DB.engine.dialect.name == 'postgresql':
+            columns = list(rows[0])
+            buffer = io.StringIO()
+            for row in rows:
+                buffer.write(','.join(_csv(row[c]) for c in columns) + '\n')
+            buffer.seek(0)
+            preparer = DB.engine.dialect.identifier_preparer
+            cursor = DB.session.connection().connection.cursor()
+            cursor.copy_expert(
+                'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                    preparer.quote(model.__table__.name),
+                    ', '.join(preparer.quote(c) for c in columns)),
+                buffer)
+        else:
+            DB.session.execute(model.__table__.insert(), rows)
+
+    def _flush(self, batch, line):
+        """
+        writes a batch in dependency order and checkpoints the line reached
+        """
+        for kind, _, _, _ in TRANSFER:
+            records = batch.get(kind)
+            if not records:
+                continue
+            if kind in ('user', 'board'):
+                records = self._merge_existing(kind, records)
+            if records:
+                self._insert(
+                    kind, [self._prepare(kind, record) for record in records])
+        self.state['line'] = line
+        self._save_checkpoint()
+        DB.session.commit()
+
+    def load(self, stream, progress=None):
+        """
+        imports every record after the checkpointed line, returning the
+        number of records read per type
+        """
+        counts, batch, size, line = {}, {}, 0, 0
+        for line, raw in enumerate(stream, 1):
+            if line <= self.state['line'] or not raw.strip():
+                continue
+            record = json.loads(raw)
+            kind = record.pop('type')
+            batch.setdefault(kind, []).append(record)
+            counts[kind] = counts.get(kind, 0) + 1
+            size += 1
+            if size >= self.batch_size:
+                self._flush(batch, line)
+                batch, size = {}, 0
+                if progress:
+                    progress(line)
+        if batch:
+            self._flush(batch, line)
+        self.finish()
+        return counts
+
+    @staticmethod
+    def finish():
+        """
+        advances postgresql sequences past the imported ids and rebuilds
+        the derived post counters
+        """
+        if DB.engine.dialect.name == 'postgresql':
+            preparer = DB.engine.dialect.identifier_preparer
+            for _, model, key, _ in TRANSFER:
+                table = model.__table__.name
+                DB.session.execute(
+                    "SELECT setval(pg_get_serial_sequence('{0}', '{1}'), "
+                    "coalesce((SELECT max({1}) FROM {2}), 1))".format(
+                        preparer.quote(table), key.key,
+                        preparer.quote(table)))
+        Post.refresh_activity()
+        DB.session.commit()
+
+
+def _csv(value):
+    """
+    formats a value for postgresql csv COPY, where only unquoted empty
+    fields are null
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (int, float)):
+        return str(value)
+    return '"' + str(value).replace('"', '""') + '"'
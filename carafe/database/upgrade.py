@@ -0,0 +1,84 @@
+""" Carafe Schema Upgrades """
+
+from sqlalchemy import inspect
+
+from carafe.database.model import Post, DB
+
+# columns added to tables that existed before them, as (table, column);
+# create_all never alters a table that is already there
+COLUMNS = (
+    ('post', 'last_activity_at'),
+    ('post', 'comment_count'),
+    ('post', 'last_comment_at'),
+    ('post', 'rendered_html'),
+    ('post', 'rendered_key'),
+    ('post', 'excerpt'),
+    ('comment', 'rendered_html'),
+    ('comment', 'rendered_key'),
+    ('board', 'erasing'),
+    ('post', 'deleted_at'),
+    ('comment', 'deleted_at'),
+)
+
+# columns derived from other rows, which are computed once they are added
+ACTIVITY_COLUMNS = frozenset((
+    'post.last_activity_at', 'post.comment_count', 'post.last_comment_at'))
+
+# indexes on those tables, by name
+INDEXES = (
+    'ix_post_bid_activity',
+    'ix_post_bid_date_live',
+    'ix_post_deleted_at',
+    'ix_comment_deleted_at',
+    'ix_comment_pid_date',
+)
+
+
+def _indexes():
+    return {
+        index.name: index
+        for table in DB.metadata.tables.values() for index in table.indexes}
+
+
+def _add_column(connection, column):
+    """
+    adds a column to its table and fills existing rows with its default
+    """
+    quote = connection.dialect.identifier_preparer.quote
+    connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+        quote(column.table.name), quote(column.name),
+        column.type.compile(dialect=connection.dialect)))
+    if column.default is not None and column.default.is_scalar:
+        connection.execute(column.table.update().where(
+            column.is_(None)).values({column.name: column.default.arg}))
+
+
+def upgrade():
+    """
+    adds the columns and indexes listed above to existing tables that lack
+    them and backfills the post activity columns, returning the names of
+    what was added
+    """
+    indexes = _indexes()
+    added = []
+    with DB.engine.begin() as connection:
+        inspector = inspect(connection)
+        tables = set(inspector.get_table_names())
+        for table, name in COLUMNS:
+            if table not in tables or name in {
+                    column['name']
+                    for column in inspector.get_columns(table)}:
+                continue
+            _add_column(connection, DB.metadata.tables[table].columns[name])
+            added.append('{}.{}'.format(table, name))
+        for name in INDEXES:
+            index = indexes[name]
+            if index.table.name in tables and name not in {
+                    existing['name']
+                    for existing in inspector.get_indexes(index.table.name)}:
+                index.create(connection)
+                added.append(name)
+    if ACTIVITY_COLUMNS.intersection(added):
+        Post.refresh_activity()
+        DB.session.commit()
+    return added
@@ -0,0 +1,283 @@
+""" Carafe Assets Extension """
+
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+
+from flask import Response, request, send_from_directory
+
+from carafe.extensions.response import COMPRESSIBLE_MIMETYPES
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+LOGGER = logging.getLogger(__name__)
+
+# files served as one, in order; bundles live beside their sources so
+# relative urls inside them resolve the same way
+BUNDLES = {
+    'style/carafe.css': (
+        'style/bootstrap.min.css', 'style/font-awesome.min.css',
+        'style/main.css'),
+    'js/carafe.js': ('js/jquery.min.js', 'js/bootstrap.min.js'),
+}
+
+# bootstrap declares the glyphicon font, which carafe neither ships nor uses
+UNSHIPPED = frozenset(
+    'fonts/glyphicons-halflings-regular.' + extension
+    for extension in ('eot', 'svg', 'ttf', 'woff', 'woff2'))
+
+# uncompressed font formats are worth precompressing too
+FONT_MIMETYPES = ('font/otf', 'font/ttf', 'application/vnd.ms-fontobject')
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+STATIC_REFERENCE = re.compile(
+    r'''url_for\(\s*['"]static['"]\s*,\s*filename\s*=\s*['"]([^'"]+)['"]''')
+
+
+class AssetError(Exception):
+    """
+    raised when the asset build finds references to files that do not exist
+    """
+
+
+def _fingerprinted(name, data):
+    stem, extension = posixpath.splitext(name)
+    return '{}.{}{}'.format(
+        stem, hashlib.sha256(data).hexdigest()[:12], extension)
+
+
+def _compressible(name):
+    mimetype = mimetypes.guess_type(name)[0] or ''
+    return mimetype.startswith('text/') or \
+        mimetype in COMPRESSIBLE_MIMETYPES + FONT_MIMETYPES
+
+
+def _external(reference):
+    return reference.startswith(('data:', '#', '/')) or \
+        '://' in reference
+
+
+def _sources(static_folder):
+    """
+    lists the files under the static folder by their url name
+    """
+    names = []
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [name for name in dirs if not name.startswith('.')]
+        for filename in files:
+            if not filename.startswith('.'):
+                names.append(posixpath.join(*os.path.relpath(
+                    os.path.join(root, filename), static_folder
+                ).split(os.sep)))
+    return sorted(names)
+
+
+def _rewrite_css(name, text, target, manifest, missing):
+    """
+    points the urls of a stylesheet at fingerprinted files, relative to
+    where the stylesheet is written
+    """
+    def replace(match):
+        quote, reference = match.group(1), match.group(2)
+        if _external(reference):
+            return match.group(0)
+        path, suffix = re.match(r'([^?#]*)(.*)', reference).groups()
+        resolved = posixpath.normpath(
+            posixpath.join(posixpath.dirname(name), path))
+        if resolved in UNSHIPPED:
+            return match.group(0)
+        if resolved not in manifest:
+            missing.append('{} (in {})'.format(resolved, name))
+            return match.group(0)
+        return 'url({0}{1}{2}{0})'.format(quote, posixpath.relpath(
+            manifest[resolved], posixpath.dirname(target)), suffix)
+    return CSS_URL.sub(replace, text)
+
+
+def _references(template_folder):
+    """
+    finds the static files templates link to
+    """
+    found = {}
+    for root, _dirs, files in os.walk(template_folder):
+        for filename in files:
+            path = os.path.join(root, filename)
+            with open(path, encoding='utf-8') as handle:
+                for name in STATIC_REFERENCE.findall(handle.read()):
+                    found.setdefault(name, os.path.relpath(
+                        path, template_folder))
+    return found
+
+
+def _missing(sources, template_folder):
+    """
+    lists the files that bundles and templates reference but do not exist
+    """
+    missing = [
+        '{} (in bundle {})'.format(source, bundle)
+        for bundle, parts in sorted(BUNDLES.items())
+        for source in parts if source not in sources]
+    missing.extend(
+        '{} (in template {})'.format(name, template)
+        for name, template in sorted(_references(template_folder).items())
+        if name not in sources and name not in BUNDLES)
+    return missing
+
+
+def _write(static_folder, path, data):
+    """
+    writes a built file along with its gzip and brotli variants when it is
+    compressible and they come out smaller
+    """
+    target = os.path.join(static_folder, *path.split('/'))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    variants = [('', data)]
+    if _compressible(path):
+        variants.append(('.gz', gzip.compress(data, compresslevel=9)))
+        if brotli:
+            variants.append(('.br', brotli.compress(data, quality=11)))
+    for suffix, content in variants:
+        if suffix and len(content) >= len(data):
+            continue
+        with open(target + suffix, 'wb') as handle:
+            handle.write(content)
+
+
+def build(static_folder, template_folder, output='build'):
+    """
+    writes every static file and bundle to the output folder under a
+    content hash, with gzip and brotli variants of compressible files, and
+    returns the manifest mapping each name to its fingerprinted path; fails
+    with AssetError when a bundle, stylesheet or template references a file
+    that does not exist
+    """
+    sources = [name for name in _sources(static_folder)
+               if not name.startswith(output + '/')]
+    missing = _missing(sources, template_folder)
+    if missing:
+        raise AssetError('Missing assets: ' + ', '.join(missing))
+
+    def read(name):
+        with open(os.path.join(static_folder, name), 'rb') as handle:
+            return handle.read()
+
+    # stylesheets are hashed last since they embed the names of the files
+    # they reference
+    names = sorted(sources + list(BUNDLES), key=lambda name: (
+        name.endswith('.css'), name))
+    manifest, files = {}, {}
+    for name in names:
+        if name.endswith('.css'):
+            target = posixpath.join(output, name)
+            texts = [_rewrite_css(
+                part, read(part).decode('utf-8'), target, manifest, missing)
+                for part in BUNDLES.get(name, (name,))]
+            data = '\n'.join(texts).encode('utf-8')
+        elif name in BUNDLES:
+            data = b'\n;\n'.join(read(part) for part in BUNDLES[name])
+        else:
+            data = read(name)
+        manifest[name] = posixpath.join(output, _fingerprinted(name, data))
+        files[manifest[name]] = data
+    if missing:
+        raise AssetError('Missing assets: ' + ', '.join(missing))
+
+    folder = os.path.join(static_folder, output)
+    shutil.rmtree(folder, ignore_errors=True)
+    for path, data in files.items():
+        _write(static_folder, path, data)
+    with open(os.path.join(folder, 'manifest.json'), 'w') as handle:
+        json.dump(manifest, handle, indent=1, sort_keys=True)
+    return manifest
+
+
+class Assets:
+    """
+    resolves static urls through the manifest written by
+    `flask carafe assets`, serving fingerprinted files precompressed with
+    far future cache headers; without a manifest files are served as they
+    are and bundles are put together on request
+    """
+
+    def __init__(self):
+        self.manifest = {}
+        self.fingerprinted = set()
+        self._app = None
+
+    def init_app(self, app):
+        """
+        loads the manifest and takes over static urls and the static view
+        """
+        self._app = app
+        path = os.path.join(
+            app.static_folder, app.config['ASSETS_BUILD'], 'manifest.json')
+        try:
+            with open(path) as handle:
+                self.manifest = json.load(handle)
+        except FileNotFoundError:
+            self.manifest = {}
+        self.fingerprinted = set(self.manifest.values())
+        app.url_defaults(self._url_defaults)
+        app.view_functions['static'] = self.send_static_file
+
+    def _url_defaults(self, endpoint, values):
+        if endpoint != 'static' or not self.manifest:
+            return
+        name = values.get('filename')
+        if name in self.manifest:
+            values['filename'] = self.manifest[name]
+        elif name not in self.fingerprinted:
+            LOGGER.warning(
+                'static file %s is not in the asset manifest, run '
+                '"flask carafe assets"', name)
+
+    def send_static_file(self, filename):
+        """
+        serves a static file, picking a precompressed variant of
+        fingerprinted files when the client accepts one
+        """
+        if filename in self.fingerprinted:
+            return self._send_fingerprinted(filename)
+        if filename in BUNDLES and not self.manifest:
+            return self._send_bundle(filename)
+        return self._app.send_static_file(filename)
+
+    def _send_fingerprinted(self, filename):
+        mimetype = mimetypes.guess_type(filename)[0]
+        for encoding, suffix in ENCODINGS:
+            if encoding in request.accept_encodings and os.path.exists(
+                    os.path.join(self._app.static_folder, filename + suffix)):
+                response = send_from_directory(
+                    self._app.static_folder, filename + suffix,
+                    mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(
+                self._app.static_folder, filename, mimetype=mimetype)
+        if _compressible(filename):
+            response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = IMMUTABLE
+        return response
+
+    def _send_bundle(self, filename):
+        separator = '\n' if filename.endswith('.css') else '\n;\n'
+        parts = []
+        for name in BUNDLES[filename]:
+            with open(os.path.join(self._app.static_folder, name)) as handle:
+                parts.append(handle.read())
+        return Response(
+            separator.join(parts),
+            mimetype=mimetypes.guess_type(filename)[0])
@@ -0,0 +1,194 @@
+""" Carafe Cache Extension """
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryCache:
+    """
+    bounded in-process LRU cache with optional per entry expiry
+    """
+
+    def __init__(self, max_entries=1024, default_ttl=None):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        gets a cached value or None if it is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        caches a value, evicting the least recently used entries when full
+        """
+        ttl = self.default_ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """
+        removes a cached value
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        removes every cached value
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class SqliteConnection:
+    """
+    a single sqlite connection per process that its threads and greenlets
+    take turns on, used as a context manager; thread locals would open a
+    connection for every request greenlet under gevent, and sqlite only
+    runs one writer at a time anyway
+    """
+
+    def __init__(self, path, setup=()):
+        self.path = path
+        self.setup = setup
+        self._conn = None
+        self._pid = None
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            # connections are not shared with a forked child
+            if self._pid != os.getpid():
+                conn = sqlite3.connect(
+                    self.path, timeout=30, isolation_level=None,
+                    check_same_thread=False)
+                for statement in self.setup:
+                    conn.execute(statement)
+                self._conn, self._pid = conn, os.getpid()
+        except BaseException:
+            self._lock.release()
+            raise
+        return self._conn
+
+    def __exit__(self, *_exc_info):
+        self._lock.release()
+
+
+class SqliteCache:
+    """
+    bounded LRU cache with per entry expiry that is stored in a local sqlite
+    file so every worker process on a host shares it; values are stored as
+    json, so nothing read back from the file is ever executed
+    """
+    # least recently used entries are only trimmed every so many writes
+    PRUNE_INTERVAL = 64
+    # reads only refresh an entry's recency once it is this stale (seconds)
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, path, max_entries=10000, default_ttl=None,
+                 table='cache'):
+        self.path = path
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.table = table
+        self._writes = 0
+        self._db = SqliteConnection(path, (
+            'PRAGMA journal_mode=WAL',
+            'PRAGMA synchronous=NORMAL',
+            'CREATE TABLE IF NOT EXISTS {0} ('
+            'key TEXT PRIMARY KEY, value BLOB, expires REAL, '
+            'accessed REAL)'.format(table),
+            'CREATE INDEX IF NOT EXISTS {0}_accessed '
+            'ON {0} (accessed)'.format(table)))
+
+    def get(self, key):
+        """
+        gets a cached value or None if it is missing or expired
+        """
+        with self._db as conn:
+            row = conn.execute(
+                'SELECT value, expires, accessed FROM {} WHERE key = ?'
+                .format(self.table), (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires, accessed = row
+            now = time.time()
+            if expires is not None and expires <= now:
+                conn.execute(
+                    'DELETE FROM {} WHERE key = ?'.format(self.table), (key,))
+                return None
+            if accessed < now - self.TOUCH_INTERVAL:
+                conn.execute(
+                    'UPDATE {} SET accessed = ? WHERE key = ?'.format(
+                        self.table), (now, key))
+        try:
+            return json.loads(value)
+        except ValueError:
+            # entries written by older versions are simply misses
+            return None
+
+    def set(self, key, value, ttl=None):
+        """
+        caches a value, periodically evicting expired and least recently
+        used entries beyond max_entries
+        """
+        ttl = self.default_ttl if ttl is None else ttl
+        now = time.time()
+        with self._db as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO {} (key, value, expires, accessed) '
+                'VALUES (?, ?, ?, ?)'.format(self.table),
+                (key, json.dumps(value), now + ttl if ttl else None, now))
+            self._writes += 1
+            if self._writes % self.PRUNE_INTERVAL == 0:
+                self.prune()
+
+    def prune(self):
+        """
+        evicts expired entries and trims the cache down to max_entries
+        """
+        with self._db as conn:
+            conn.execute(
+                'DELETE FROM {} WHERE expires <= ?'.format(self.table),
+                (time.time(),))
+            conn.execute(
+                'DELETE FROM {0} WHERE key IN (SELECT key FROM {0} '
+                'ORDER BY accessed DESC LIMIT -1 OFFSET ?)'.format(
+                    self.table), (self.max_entries,))
+
+    def delete(self, key):
+        """
+        removes a cached value
+        """
+        with self._db as conn:
+            conn.execute(
+                'DELETE FROM {} WHERE key = ?'.format(self.table), (key,))
+
+    def clear(self):
+        """
+        removes every cached value
+        """
+        with self._db as conn:
+            conn.execute('DELETE FROM {}'.format(self.table))
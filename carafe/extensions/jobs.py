@@ -0,0 +1,194 @@
+""" Carafe Jobs Extension """
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import and_, event, or_
+
+from carafe.database.model import Job, DB
+
+LOGGER = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """
+    runs registered tasks once the transaction that queued them commits;
+    the thread backend runs them in a per process pool, the inline backend
+    runs them before the request returns and the database backend stores
+    them in the job table, within the same transaction, for
+    `flask carafe worker` to pick up
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self.backend = 'thread'
+        self.retries = 3
+        self.timeout = 300
+        self.workers = 2
+        self._app = None
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    def init_app(self, app):
+        """
+        configures the backend and hooks job dispatch onto session commits
+        """
+        self._app = app
+        self.backend = app.config['JOBS_BACKEND']
+        self.retries = app.config['JOBS_RETRIES']
+        self.timeout = app.config['JOBS_TIMEOUT']
+        self.workers = app.config['JOBS_WORKERS']
+        if not event.contains(
+                SignallingSession, 'after_commit', self._after_commit):
+            event.listen(
+                SignallingSession, 'after_commit', self._after_commit)
+            event.listen(
+                SignallingSession, 'after_rollback', self._after_rollback)
+
+    def task(self, name):
+        """
+        decorator that registers a function as the task with the given name
+        """
+        def register(func):
+            self.tasks[name] = func
+            return func
+        return register
+
+    def enqueue(self, name, *args):
+        """
+        queues a task to run after the current transaction commits; args
+        must be json serializable
+        """
+        if name not in self.tasks:
+            raise KeyError('Unknown task "{}"'.format(name))
+        if self.backend == 'database':
+            DB.session.add(Job(name, json.dumps(args)))
+        else:
+            DB.session.info.setdefault('carafe_jobs', []).append((name, args))
+
+    @staticmethod
+    def _after_rollback(session):
+        session.info.pop('carafe_jobs', None)
+
+    def _after_commit(self, session):
+        jobs = session.info.pop('carafe_jobs', None)
+        for name, args in jobs or ():
+            if self.backend == 'inline':
+                # the committed session cannot run queries from inside its
+                # own commit, so the task gets a thread and session of its own
+                worker = threading.Thread(target=self._run, args=(name, args))
+                worker.start()
+                worker.join()
+            else:
+                self._pool().submit(self._run, name, args)
+
+    def _pool(self):
+        with self._lock:
+            # worker threads do not survive a fork, so forked processes
+            # start their own pool
+            if self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix='carafe-jobs')
+                self._executor_pid = os.getpid()
+        return self._executor
+
+    def _run(self, name, args):
+        """
+        runs a task in an application context, retrying with exponential
+        backoff when it fails
+        """
+        with self._app.app_context():
+            for attempt in range(1, self.retries + 1):
+                try:
+                    self.tasks[name](*args)
+                    DB.session.commit()
+                    return
+                except Exception:  # pylint: disable=broad-except
+                    DB.session.rollback()
+                    if attempt == self.retries:
+                        LOGGER.exception(
+                            'job %s%r failed after %d attempts',
+                            name, tuple(args), attempt)
+                        return
+                    LOGGER.warning(
+                        'job %s%r failed, retrying', name, tuple(args),
+                        exc_info=True)
+                    time.sleep(2 ** attempt)
+
+    def _claim(self):
+        """
+        claims the next due job, or a job whose worker went away, returning
+        its id, task, arguments and attempt number
+        """
+        now = datetime.now()
+        query = Job.query.filter(or_(
+            and_(Job.state == 'queued', Job.run_at <= now),
+            and_(Job.state == 'running',
+                 Job.locked_at < now - timedelta(seconds=self.timeout))
+        )).order_by(Job.run_at, Job.jid)
+        if DB.engine.dialect.name == 'postgresql':
+            query = query.with_for_update(skip_locked=True)
+        job = query.first()
+        if job is None:
+            DB.session.rollback()
+            return None
+
+        # the conditional update makes claiming safe on databases without
+        # row locks, only one worker can move the job from its old state
+        claimed = Job.query.filter_by(
+            jid=job.jid, state=job.state, attempts=job.attempts
+        ).update({
+            Job.state: 'running',
+            Job.locked_at: now,
+            Job.attempts: Job.attempts + 1
+        }, synchronize_session=False)
+        claim = (job.jid, job.task, job.args, job.attempts + 1)
+        DB.session.commit()
+        return claim if claimed else self._claim()
+
+    def _execute(self, jid, name, args, attempt):
+        """
+        runs a claimed job, deleting it on success and otherwise scheduling
+        a retry or marking it failed
+        """
+        try:
+            self.tasks[name](*json.loads(args))
+            Job.query.filter_by(jid=jid).delete()
+            DB.session.commit()
+            return True
+        except Exception as error:  # pylint: disable=broad-except
+            DB.session.rollback()
+            failed = attempt >= self.retries
+            LOGGER.warning(
+                'job %d (%s) failed on attempt %d', jid, name, attempt,
+                exc_info=True)
+            Job.query.filter_by(jid=jid).update({
+                Job.state: 'failed' if failed else 'queued',
+                Job.run_at: datetime.now() + timedelta(seconds=2 ** attempt),
+                Job.error: '{}: {}'.format(error.__class__.__name__, error)
+            }, synchronize_session=False)
+            DB.session.commit()
+            return False
+
+    def work(self, once=False, poll=1.0):
+        """
+        runs jobs from the job table until interrupted, or until none are
+        due when once is set, returning the number of jobs that succeeded
+        """
+        succeeded = 0
+        while True:
+            claim = self._claim()
+            if claim is None:
+                if once:
+                    return succeeded
+                time.sleep(poll)
+                continue
+            succeeded += self._execute(*claim)
@@ -0,0 +1,234 @@
+""" Carafe Live Extension """
+
+import json
+import logging
+import os
+import select
+import threading
+import time
+from collections import deque
+
+from flask import Response, render_template
+from sqlalchemy import text
+from sqlalchemy.orm import joinedload, undefer_group
+
+from carafe.database.model import Post, Comment, DB
+
+LOGGER = logging.getLogger(__name__)
+
+CHANNEL = 'carafe_live'
+
+
+class Subscription:
+    """
+    buffer of messages waiting to be sent to one connected reader
+    """
+
+    def __init__(self, size):
+        self.messages = deque(maxlen=size)
+        self.ready = threading.Event()
+
+    def push(self, message):
+        """
+        queues a message, dropping the oldest once the buffer is full
+        """
+        self.messages.append(message)
+        self.ready.set()
+
+    def pull(self, timeout):
+        """
+        waits up to timeout seconds for messages and takes all of them
+        """
+        self.ready.wait(timeout)
+        self.ready.clear()
+        messages = []
+        while self.messages:
+            messages.append(self.messages.popleft())
+        return messages
+
+
+class Broadcaster:
+    """
+    fans messages out to the subscriptions of a channel within a process
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self._lock = threading.Lock()
+        self._channels = {}
+
+    def subscribe(self, channel):
+        """
+        subscribes to a channel
+        """
+        subscription = Subscription(self.size)
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, channel, subscription):
+        """
+        removes a subscription, forgetting channels left without any
+        """
+        with self._lock:
+            subscriptions = self._channels.get(channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._channels.pop(channel, None)
+
+    def has_subscribers(self, channel):
+        """
+        whether anything in this process listens on a channel
+        """
+        with self._lock:
+            return channel in self._channels
+
+    def subscribers(self):
+        """
+        gets the number of subscriptions in this process
+        """
+        with self._lock:
+            return sum(len(subs) for subs in self._channels.values())
+
+    def publish(self, channel, message):
+        """
+        sends a message to every subscription of a channel
+        """
+        with self._lock:
+            subscriptions = list(self._channels.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.push(message)
+
+
+class LiveComments:
+    """
+    server sent event streams of comment changes per post; changes are
+    announced with postgresql NOTIFY so every node hears them, each node
+    rendering a fragment once per change for all of its readers, while
+    other databases only reach readers connected to the same process
+    """
+
+    def __init__(self):
+        self.broadcaster = Broadcaster()
+        self.heartbeat = 15
+        self._app = None
+        self._lock = threading.Lock()
+        self._listener_pid = None
+
+    def init_app(self, app):
+        """
+        configures buffering and the keepalive interval
+        """
+        self._app = app
+        self.broadcaster = Broadcaster(app.config['LIVE_BUFFER'])
+        self.heartbeat = app.config['LIVE_HEARTBEAT']
+
+    @staticmethod
+    def _notifies():
+        return DB.engine.dialect.name == 'postgresql'
+
+    def publish(self, pid, cid, action):
+        """
+        announces that a comment was created, edited, deleted or revived;
+        called after the change is committed
+        """
+        if self._notifies():
+            DB.session.execute(
+                text('SELECT pg_notify(:channel, :payload)'), {
+                    'channel': CHANNEL,
+                    'payload': json.dumps(
+                        {'pid': int(pid), 'cid': int(cid), 'action': action})
+                })
+            DB.session.commit()
+        else:
+            self._deliver(int(pid), int(cid), action)
+
+    def _fragment(self, pid, cid):
+        """
+        renders a comment as an anonymous reader sees it
+        """
+        with self._app.test_request_context():
+            comment = Comment.query.options(
+                undefer_group('rendered'), joinedload(Comment.author)
+            ).filter_by(pid=pid, cid=cid).first()
+            if comment is None:
+                return None
+            bid = DB.session.query(Post.bid).filter_by(pid=pid).scalar()
+            return render_template('comment.html', c=comment, bid=bid)
+
+    def _deliver(self, pid, cid, action):
+        if not self.broadcaster.has_subscribers(pid):
+            return
+        html = self._fragment(pid, cid)
+        if html is not None:
+            self.broadcaster.publish(pid, json.dumps(
+                {'action': action, 'cid': cid, 'html': html}))
+
+    def _ensure_listener(self):
+        with self._lock:
+            # threads do not survive a fork, so each worker listens itself
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+        threading.Thread(
+            target=self._listen, name='carafe-live', daemon=True).start()
+
+    def _listen(self):
+        """
+        relays notifications to local subscribers, reconnecting whenever
+        the listening connection fails
+        """
+        while True:
+            try:
+                connection = DB.get_engine(self._app).raw_connection()
+                # the connection is never handed back to the pool
+                connection.detach()
+                try:
+                    self._relay(connection.connection)
+                finally:
+                    connection.close()
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('live comment listener failed')
+                time.sleep(5)
+
+    def _relay(self, raw):
+        raw.autocommit = True
+        raw.cursor().execute('LISTEN {}'.format(CHANNEL))
+        while True:
+            if not select.select([raw], [], [], self.heartbeat)[0]:
+                continue
+            raw.poll()
+            while raw.notifies:
+                notify = raw.notifies.pop(0)
+                try:
+                    message = json.loads(notify.payload)
+                    self._deliver(
+                        message['pid'], message['cid'], message['action'])
+                except Exception:  # pylint: disable=broad-except
+                    LOGGER.exception(
+                        'could not relay live comment %s', notify.payload)
+
+    def stream(self, pid):
+        """
+        responds with an event stream of the comment changes of a post; the
+        stream holds no database connection while it waits
+        """
+        if self._notifies():
+            self._ensure_listener()
+        subscription = self.broadcaster.subscribe(pid)
+
+        def events():
+            try:
+                yield 'retry: 5000\n\n'
+                while True:
+                    messages = subscription.pull(self.heartbeat)
+                    if not messages:
+                        yield ': keepalive\n\n'
+                    for message in messages:
+                        yield 'event: comment\ndata: {}\n\n'.format(message)
+            finally:
+                self.broadcaster.unsubscribe(pid, subscription)
+
+        return Response(events(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'})
@@ -1,8 +1,115 @@
 """ Carafe Login Extension """
 
+import threading
+
 from flask_login import AnonymousUserMixin
+from sqlalchemy import event
+
+from carafe.extensions.cache import MemoryCache
 
 
 class AnonymousUser(AnonymousUserMixin):
     """ Carafe Anonymous User Mixin """
     is_admin = False
+
+
+class UserPrincipal:
+    """
+    lightweight identity of a logged in user that is cached between
+    requests in place of the full User row
+    """
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, uid, username, is_admin, is_active):
+        self.uid = uid
+        self.username = username
+        self.is_admin = is_admin
+        self.is_active = is_active
+
+    @classmethod
+    def from_user(cls, user):
+        """
+        builds a principal from a User row
+        """
+        return cls(
+            user.uid, user.username, bool(user.is_admin),
+            bool(user.is_active))
+
+    def get_id(self):
+        """
+        retrieves the user's id
+        """
+        return self.uid
+
+
+class PrincipalCache:
+    """
+    per worker ttl cache of user principals so identity checks do not hit
+    the database on every authenticated request
+    """
+
+    def __init__(self):
+        self._cache = MemoryCache()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+        self._app = None
+
+    def init_app(self, app):
+        """
+        configures the cache size and principal lifetime from the application
+        """
+        self._app = app
+        self._cache = MemoryCache(
+            max_entries=app.config['USER_CACHE_SIZE'],
+            default_ttl=app.config['USER_CACHE_TTL'])
+
+    def watch(self, model):
+        """
+        evicts cached principals whenever their user row changes in this
+        worker, other workers pick the change up once the ttl lapses
+        """
+        def evict(_mapper, _connection, target):
+            self.invalidate(target.uid)
+        event.listen(model, 'after_update', evict)
+        event.listen(model, 'after_delete', evict)
+
+    def load(self, uid, loader):
+        """
+        gets the principal of a user, calling loader for the User row on a
+        cache miss
+        """
+        principal = self._cache.get(str(uid))
+        self._count('hit' if principal else 'miss')
+        if principal is None:
+            user = loader(uid)
+            if user is None:
+                return None
+            principal = UserPrincipal.from_user(user)
+            self._cache.set(str(uid), principal)
+        return principal
+
+    def _count(self, result):
+        with self._lock:
+            self._stats[{'hit': 'hits', 'miss': 'misses'}[result]] += 1
+        metrics = self._app and self._app.extensions.get('carafe_metrics')
+        if metrics is not None:
+            metrics.inc(
+                'carafe_user_cache_total',
+                'User principal cache lookups by result.', result=result)
+
+    def invalidate(self, uid):
+        """
+        evicts the principal of a user
+        """
+        self._cache.delete(str(uid))
+
+    def stats(self):
+        """
+        gets this worker's hit and miss counts
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
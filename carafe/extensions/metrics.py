@@ -0,0 +1,462 @@
+""" Carafe Metrics Extension """
+
+import atexit
+import glob
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from uuid import uuid4
+
+from flask import (
+    before_render_template, g, has_request_context, request,
+    request_finished, request_started, template_rendered
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from carafe.signals import CONTENT_RENDERED, RESPONSE_COMPRESSED
+
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# histograms observed for every request, keyed by the timing they record
+REQUEST_HISTOGRAMS = (
+    ('duration', 'carafe_request_duration_seconds',
+     'Time spent handling a request.', DURATION_BUCKETS),
+    ('sql_count', 'carafe_request_sql_queries',
+     'SQL statements executed by a request.', QUERY_BUCKETS),
+    ('sql', 'carafe_request_sql_seconds',
+     'Time a request spent executing SQL.', DURATION_BUCKETS),
+    ('template', 'carafe_request_template_seconds',
+     'Time a request spent rendering templates.', DURATION_BUCKETS),
+    ('render', 'carafe_request_content_render_seconds',
+     'Time a request spent rendering markdown and embeds.',
+     DURATION_BUCKETS),
+    ('compress', 'carafe_request_compress_seconds',
+     'Time a request spent compressing its response.', DURATION_BUCKETS),
+    ('size', 'carafe_response_bytes',
+     'Size of response bodies as sent.', SIZE_BUCKETS),
+)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _bound(bound):
+    return '+Inf' if bound is None else repr(float(bound))
+
+
+class Registry:
+    """
+    thread safe store of counters and histograms that can be snapshotted,
+    merged with the snapshots of other workers and written out in the
+    prometheus text format
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _series(self, kind, name, help_text, labels, size, buckets=None):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = {
+                'type': kind, 'help': help_text, 'buckets': buckets,
+                'series': {}}
+        key = json.dumps(sorted(labels.items()))
+        series = metric['series'].get(key)
+        if series is None:
+            series = metric['series'][key] = [0] * size
+        return series
+
+    def inc(self, name, help_text, value=1, **labels):
+        """
+        increments a counter
+        """
+        with self._lock:
+            self._series('counter', name, help_text, labels, 1)[0] += value
+
+    def observe(self, name, help_text, buckets, value, **labels):
+        """
+        records a value in a histogram; the series holds the cumulative
+        bucket counts followed by the sum and count
+        """
+        with self._lock:
+            series = self._series(
+                'histogram', name, help_text, labels, len(buckets) + 2,
+                list(buckets))
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def snapshot(self):
+        """
+        gets a json serializable copy of every metric
+        """
+        with self._lock:
+            return json.loads(json.dumps(self._metrics))
+
+    @staticmethod
+    def merge(snapshots):
+        """
+        sums snapshots taken in different workers
+        """
+        merged = {}
+        for snapshot in snapshots:
+            for name, metric in snapshot.items():
+                target = merged.setdefault(name, dict(metric, series={}))
+                for key, values in metric['series'].items():
+                    current = target['series'].get(key)
+                    target['series'][key] = values if current is None else [
+                        a + b for a, b in zip(current, values)]
+        return merged
+
+    @staticmethod
+    def exposition(metrics):
+        """
+        formats merged metrics in the prometheus text format
+        """
+        lines = []
+        for name in sorted(metrics):
+            metric = metrics[name]
+            lines.append('# HELP {} {}'.format(name, metric['help']))
+            lines.append('# TYPE {} {}'.format(name, metric['type']))
+            for key in sorted(metric['series']):
+                pairs = [tuple(pair) for pair in json.loads(key)]
+                values = metric['series'][key]
+                if metric['type'] == 'counter':
+                    lines.append('{}{} {}'.format(
+                        name, _labels(pairs), values[0]))
+                    continue
+                bounds = metric['buckets'] + [None]
+                counts = values[:-2] + [values[-1]]
+                for bound, count in zip(bounds, counts):
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _labels(pairs + [('le', _bound(bound))]),
+                        count))
+                lines.append('{}_sum{} {}'.format(
+                    name, _labels(pairs), values[-2]))
+                lines.append('{}_count{} {}'.format(
+                    name, _labels(pairs), values[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+def _folded(frame):
+    """
+    formats a stack as a folded flame graph line, outermost frame first
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{} ({}:{})'.format(
+            code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+def _alive(pid):
+    """
+    whether a process with the pid exists
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _green_threads():
+    """
+    whether gevent has replaced threads with greenlets, whose stacks
+    sys._current_frames does not report
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+class Sampler(threading.Thread):
+    """
+    background thread that periodically samples the stacks of the request
+    threads being profiled; a single sampler serves every request
+    """
+
+    def __init__(self, interval):
+        super().__init__(name='carafe-sampler', daemon=True)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._profiles = {}
+
+    def begin(self, ident):
+        """
+        starts collecting samples for a thread
+        """
+        with self._lock:
+            self._profiles[ident] = Counter()
+
+    def end(self, ident):
+        """
+        stops collecting samples for a thread and returns them
+        """
+        with self._lock:
+            return self._profiles.pop(ident, Counter())
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            with self._lock:
+                for ident, samples in self._profiles.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[_folded(frame)] += 1
+
+
+class Metrics:
+    """
+    per request instrumentation recording sql, template, markdown render
+    and compression time along with response sizes into per endpoint
+    histograms, logging slow requests with an optional sampling profile
+    """
+
+    def __init__(self):
+        self.registry = Registry()
+        self.token = ''
+        self.path = ''
+        self.flush_interval = 10
+        self.slow = 0
+        self.profile_interval = 0
+        self._sampler = None
+        self._sampler_pid = None
+        self._flushed = 0
+        self._spool = None
+        self._app = None
+
+    def init_app(self, app):
+        """
+        configures the extension and connects it to sqlalchemy, flask and
+        carafe signals
+        """
+        self._app = app
+        app.extensions['carafe_metrics'] = self
+        self.token = app.config['METRICS_TOKEN']
+        self.path = app.config['METRICS_PATH']
+        self.flush_interval = app.config['METRICS_FLUSH_INTERVAL']
+        self.slow = app.config['SLOW_REQUEST_MS'] / 1000
+        self.profile_interval = app.config['SLOW_REQUEST_PROFILE_MS'] / 1000
+        if self.profile_interval and _green_threads():
+            app.logger.warning(
+                'slow request profiling is unavailable with gevent workers')
+            self.profile_interval = 0
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+        atexit.unregister(self.discard)
+        atexit.register(self.discard)
+
+        if not event.contains(
+                Engine, 'before_cursor_execute', self._before_query):
+            event.listen(Engine, 'before_cursor_execute', self._before_query)
+            event.listen(Engine, 'after_cursor_execute', self._after_query)
+        request_started.connect(self._started, app)
+        request_finished.connect(self._finished, app)
+        before_render_template.connect(self._before_template, app)
+        template_rendered.connect(self._after_template, app)
+        CONTENT_RENDERED.connect(self._timed('render'))
+        RESPONSE_COMPRESSED.connect(self._timed('compress'))
+
+    def inc(self, name, help_text, value=1, **labels):
+        """
+        increments an application counter exposed alongside request metrics
+        """
+        self.registry.inc(name, help_text, value, **labels)
+
+    def observe(self, name, help_text, buckets, value, **labels):
+        """
+        records an application value in a histogram exposed alongside
+        request metrics
+        """
+        self.registry.observe(name, help_text, buckets, value, **labels)
+
+    @staticmethod
+    def _current():
+        if has_request_context():
+            return g.get('_metrics')
+        return None
+
+    def _timed(self, timing):
+        # kept on the instance since blinker only holds receivers weakly
+        def receiver(_sender, duration):
+            current = self._current()
+            if current is not None:
+                current[timing] += duration
+        setattr(self, '_receive_' + timing, receiver)
+        return receiver
+
+    def _sampler_for_process(self):
+        # threads do not survive a fork, so each worker starts its own
+        if self._sampler is None or self._sampler_pid != os.getpid():
+            self._sampler = Sampler(self.profile_interval)
+            self._sampler_pid = os.getpid()
+            self._sampler.start()
+        return self._sampler
+
+    def _started(self, _sender, **_extra):
+        g._metrics = Counter(started=time.perf_counter())
+        if self.slow and self.profile_interval:
+            self._sampler_for_process().begin(threading.get_ident())
+
+    def _before_query(self, conn, *_args):
+        if self._current() is not None:
+            conn.info.setdefault('carafe_query_start', []).append(
+                time.perf_counter())
+
+    def _after_query(self, conn, *_args):
+        current = self._current()
+        starts = conn.info.get('carafe_query_start')
+        if current is not None and starts:
+            current['sql'] += time.perf_counter() - starts.pop()
+            current['sql_count'] += 1
+
+    def _before_template(self, _sender, **_extra):
+        current = self._current()
+        if current is not None:
+            g.setdefault('_template_starts', []).append(time.perf_counter())
+
+    def _after_template(self, _sender, **_extra):
+        current = self._current()
+        starts = g.get('_template_starts')
+        if current is not None and starts:
+            current['template'] += time.perf_counter() - starts.pop()
+
+    def _finished(self, _sender, response, **_extra):
+        current = g.pop('_metrics', None)
+        if current is None:
+            return
+        current['duration'] = time.perf_counter() - current['started']
+        # measuring a streamed body would consume it
+        if not response.is_streamed:
+            current['size'] = response.calculate_content_length() or 0
+        endpoint = request.endpoint or 'unmatched'
+        for timing, name, help_text, buckets in REQUEST_HISTOGRAMS:
+            self.registry.observe(
+                name, help_text, buckets, current[timing], endpoint=endpoint)
+        self.registry.inc(
+            'carafe_requests_total', 'Requests handled.',
+            endpoint=endpoint, status=response.status_code)
+
+        profile = None
+        if self.slow and self.profile_interval:
+            profile = self._sampler_for_process().end(threading.get_ident())
+        if self.slow and current['duration'] >= self.slow:
+            self._log_slow(endpoint, current, profile)
+        if self.path and time.time() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def _log_slow(self, endpoint, current, profile):
+        message = (
+            'Slow request {} {} ({}): {:.0f}ms total, {} queries in '
+            '{:.0f}ms, templates {:.0f}ms, content render {:.0f}ms, '
+            'compress {:.0f}ms, {} bytes').format(
+                request.method, request.full_path.rstrip('?'), endpoint,
+                current['duration'] * 1000, current['sql_count'],
+                current['sql'] * 1000, current['template'] * 1000,
+                current['render'] * 1000, current['compress'] * 1000,
+                current['size'])
+        if profile:
+            message += '\nSampled stacks (folded, most frequent first):\n' + \
+                '\n'.join('{} {}'.format(stack, count)
+                          for stack, count in profile.most_common(20))
+        self._app.logger.warning(message)
+
+    def flush(self):
+        """
+        writes this worker's metrics to the shared metrics directory
+        """
+        if not self.path:
+            return
+        self._flushed = time.time()
+        target = self._spool_file()
+        temp = target + '.tmp'
+        with open(temp, 'w') as handle:
+            json.dump(self.registry.snapshot(), handle)
+        os.replace(temp, target)
+
+    def _spool_file(self):
+        """
+        gets this process's spool file, named by its pid and a token of its
+        own so a process reusing a pid never overwrites, and so rewinds, the
+        counters of the last one; files left under its pid are removed
+        """
+        pid = os.getpid()
+        if self._spool is None or self._spool[0] != pid:
+            for name in glob.glob(
+                    os.path.join(self.path, '{}-*.json'.format(pid))):
+                _remove(name)
+            self._spool = (pid, os.path.join(
+                self.path, '{}-{}.json'.format(pid, uuid4().hex)))
+        return self._spool[1]
+
+    def discard(self):
+        """
+        removes this process's spool file, called when it exits
+        """
+        if self._spool is not None and self._spool[0] == os.getpid():
+            _remove(self._spool[1])
+
+    def authorized(self):
+        """
+        whether the request carries the configured metrics bearer token
+        """
+        header = request.headers.get('Authorization', '')
+        return bool(self.token) and hmac.compare_digest(
+            header.encode('utf-8'),
+            'Bearer {}'.format(self.token).encode('utf-8'))
+
+    def exposition(self):
+        """
+        gets the metrics of every worker in the prometheus text format
+        """
+        if not self.path:
+            return Registry.exposition(self.registry.snapshot())
+        self.flush()
+        snapshots = []
+        for name in glob.glob(os.path.join(self.path, '*.json')):
+            pid = os.path.splitext(os.path.basename(name))[0].partition(
+                '-')[0]
+            # workers killed without exiting leave their files behind; the
+            # files of live workers count however long they have been idle,
+            # or their counters would drop out and come back
+            if not pid.isdigit() or not _alive(int(pid)):
+                _remove(name)
+                continue
+            try:
+                with open(name) as handle:
+                    snapshots.append(json.load(handle))
+            except (OSError, ValueError):
+                continue
+        return Registry.exposition(Registry.merge(snapshots))
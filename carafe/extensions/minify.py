@@ -0,0 +1,37 @@
+""" Carafe Minify Extension """
+
+import re
+
+from jinja2.ext import Extension
+
+# whitespace inside these elements is significant and is left untouched
+PRESERVED = re.compile(
+    r'(<(pre|textarea|script)\b.*?</\2\s*>)', re.IGNORECASE | re.DOTALL)
+WHITESPACE = re.compile(r'\s+')
+
+
+def minify_template(source):
+    """
+    collapses runs of whitespace in template source to a single space,
+    skipping elements whose whitespace is significant
+    """
+    parts = PRESERVED.split(source)
+    minified = []
+    # split yields text, the preserved element and its tag name in turn
+    for index in range(0, len(parts), 3):
+        minified.append(WHITESPACE.sub(' ', parts[index]))
+        if index + 1 < len(parts):
+            minified.append(parts[index + 1])
+    return ''.join(minified).strip()
+
+
+class MinifyExtension(Extension):
+    """
+    jinja extension that minifies html templates once when they are
+    compiled rather than minifying every rendered response
+    """
+
+    def preprocess(self, source, name, filename=None):
+        if name and not name.endswith('.html'):
+            return source
+        return minify_template(source)
@@ -0,0 +1,159 @@
+""" Carafe OEmbed Extension """
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from micawber.exceptions import ProviderException, ProviderNotFoundException
+from micawber.providers import ProviderRegistry, make_key
+
+from carafe.extensions.cache import MemoryCache, SqliteCache
+
+LOGGER = logging.getLogger(__name__)
+
+
+def default_fetch(provider, url, params):
+    """
+    fetches oembed data for a url from its provider over http
+    """
+    return provider.request(url, **params)
+
+
+class OEmbedResolver(ProviderRegistry):
+    """
+    micawber provider registry that resolves urls from a bounded shared
+    cache and fetches cache misses in the background instead of on the
+    request path, so unresolved urls render as plain links until they are
+    available; providers, a micawber bootstrap function, registers the
+    providers when urls are first matched
+    """
+
+    def __init__(self, cache=None, fetch=None, ttl=86400, failure_ttl=900,
+                 workers=2, providers=None):
+        super().__init__()
+        self.store = cache or MemoryCache()
+        self.fetch = fetch or default_fetch
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.workers = workers
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._inflight = set()
+        self._executor = None
+        self._executor_pid = None
+        self._providers = providers
+
+    def __iter__(self):
+        if self._providers is not None:
+            with self._lock:
+                if self._providers is not None:
+                    self._providers(registry=self)
+                    self._providers = None
+        return super().__iter__()
+
+    def init_app(self, app):
+        """
+        configures the shared cache and fetch settings from the application
+        """
+        path = app.config['OEMBED_CACHE_PATH']
+        if path:
+            self.store = SqliteCache(
+                path, max_entries=app.config['OEMBED_CACHE_SIZE'],
+                table='oembed')
+        else:
+            self.store = MemoryCache(
+                max_entries=app.config['OEMBED_CACHE_SIZE'])
+        self.ttl = app.config['OEMBED_TTL']
+        self.failure_ttl = app.config['OEMBED_FAILURE_TTL']
+        self.workers = app.config['OEMBED_WORKERS']
+
+    @contextmanager
+    def blocking(self):
+        """
+        resolves cache misses synchronously for the current thread, used
+        where waiting on providers is acceptable such as commands and jobs
+        """
+        previous = getattr(self._local, 'blocking', False)
+        self._local.blocking = True
+        try:
+            yield
+        finally:
+            self._local.blocking = previous
+
+    @contextmanager
+    def track(self):
+        """
+        collects the urls left pending by requests made in this block
+        """
+        previous = getattr(self._local, 'pending', None)
+        self._local.pending = pending = []
+        try:
+            yield pending
+        finally:
+            self._local.pending = previous
+
+    def request(self, url, **params):
+        provider = self.provider_for_url(url)
+        if provider is None:
+            raise ProviderNotFoundException(
+                'Provider not found for "{}"'.format(url))
+
+        key = make_key(url, params)
+        entry = self.store.get(key)
+        if entry is None:
+            if getattr(self._local, 'blocking', False):
+                entry = self._resolve(key, provider, url, params)
+            else:
+                self._schedule(key, provider, url, params)
+                pending = getattr(self._local, 'pending', None)
+                if pending is not None:
+                    pending.append(url)
+                raise ProviderException('Pending "{}"'.format(url))
+
+        if 'error' in entry:
+            raise ProviderException(entry['error'])
+        return entry['data']
+
+    def _resolve(self, key, provider, url, params):
+        """
+        fetches a url from its provider and caches the outcome, failures
+        included so broken providers are not retried on every render
+        """
+        try:
+            entry = {'data': self.fetch(provider, url, params)}
+            ttl = self.ttl
+        except Exception as error:  # pylint: disable=broad-except
+            LOGGER.info('oembed fetch failed for %s: %s', url, error)
+            entry = {'error': str(error) or error.__class__.__name__}
+            ttl = self.failure_ttl
+        self.store.set(key, entry, ttl=ttl)
+        return entry
+
+    def _schedule(self, key, provider, url, params):
+        """
+        queues a background fetch unless one is already in flight
+        """
+        with self._lock:
+            # worker threads do not survive a fork, so forked processes
+            # start their own pool
+            if self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix='carafe-oembed')
+                self._executor_pid = os.getpid()
+                self._inflight.clear()
+            if key in self._inflight:
+                return
+            self._inflight.add(key)
+        future = self._executor.submit(
+            self._resolve, key, provider, url, params)
+        future.add_done_callback(lambda _: self._finish(key))
+
+    def _finish(self, key):
+        """
+        marks a background fetch as complete
+        """
+        with self._lock:
+            self._inflight.discard(key)
@@ -0,0 +1,139 @@
+""" Carafe Page Cache Extension """
+
+import threading
+from functools import wraps
+from hashlib import sha1
+from uuid import uuid4
+
+from flask import Response, make_response, request, session
+from flask_login import current_user
+
+from carafe.extensions.cache import MemoryCache, SqliteCache
+
+
+def board_scope(bid):
+    """
+    version scope of pages that show a board's posts
+    """
+    return 'board:{}'.format(bid)
+
+
+def post_scope(pid):
+    """
+    version scope of pages that show a post and its comments
+    """
+    return 'post:{}'.format(pid)
+
+
+INDEX_SCOPE = 'index'
+
+
+class PageCache:
+    """
+    full page cache for anonymous readers; pages are keyed by their path and
+    the version counters of the content they show, so writes invalidate them
+    by bumping a counter instead of searching for stale pages
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.ttl = 300
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'bypasses': 0}
+
+    def init_app(self, app):
+        """
+        configures the cache backend from the application, the cache stays
+        disabled unless PAGE_CACHE is memory or sqlite
+        """
+        kind = app.config['PAGE_CACHE']
+        size = app.config['PAGE_CACHE_SIZE']
+        if kind == 'memory':
+            self.backend = MemoryCache(max_entries=size)
+        elif kind == 'sqlite':
+            self.backend = SqliteCache(
+                app.config['PAGE_CACHE_PATH'], max_entries=size,
+                table='page')
+        else:
+            self.backend = None
+        self.ttl = app.config['PAGE_CACHE_TTL']
+        app.extensions['carafe_page_cache'] = self
+
+    def stats(self):
+        """
+        gets this worker's hit, miss and bypass counts
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def version(self, scope):
+        """
+        gets the current version token of a scope
+        """
+        version = self.backend.get('v:' + scope)
+        if version is None:
+            # an evicted counter simply starts a new version
+            version = uuid4().hex
+            self.backend.set('v:' + scope, version, ttl=0)
+        return version
+
+    def bump(self, *scopes):
+        """
+        invalidates every cached page that shows one of the scopes
+        """
+        if self.backend is None:
+            return
+        for scope in scopes:
+            self.backend.set('v:' + scope, uuid4().hex, ttl=0)
+
+    @staticmethod
+    def cacheable():
+        """
+        whether the current request may be answered from the cache
+        """
+        return request.method == 'GET' and \
+            not current_user.is_authenticated and \
+            '_flashes' not in session
+
+    def cached(self, scopes):
+        """
+        decorator that caches a view for anonymous readers; scopes is called
+        with the view arguments and returns the scopes the page shows
+        """
+        def decorator(view):
+            @wraps(view)
+            def decorated(*args, **kwargs):
+                if self.backend is None:
+                    return view(*args, **kwargs)
+                if not self.cacheable():
+                    self._count('bypasses')
+                    return view(*args, **kwargs)
+
+                versions = [
+                    self.version(scope) for scope in scopes(**kwargs)]
+                key = 'p:' + sha1('|'.join(
+                    [request.full_path] + versions).encode('utf-8')
+                ).hexdigest()
+                entry = self.backend.get(key)
+                if entry is not None:
+                    self._count('hits')
+                    body, mimetype = entry
+                    return Response(body, mimetype=mimetype)
+
+                self._count('misses')
+                response = make_response(view(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    self.backend.set(
+                        key,
+                        (response.get_data(as_text=True), response.mimetype),
+                        ttl=self.ttl)
+                return response
+            return decorated
+        return decorator
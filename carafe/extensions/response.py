@@ -0,0 +1,80 @@
+""" Carafe Response Extension """
+
+import gzip
+import time
+from functools import wraps
+
+from flask import current_app, make_response, request
+
+from carafe.signals import RESPONSE_COMPRESSED
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = (
+    'application/javascript', 'application/json', 'image/svg+xml')
+
+
+def negotiate_encoding(response):
+    """
+    picks the content coding a response will be compressed with, if any
+    """
+    mimetype = response.mimetype or ''
+    if not (mimetype.startswith('text/') or
+            mimetype in COMPRESSIBLE_MIMETYPES):
+        return None
+    if response.direct_passthrough or response.is_streamed or \
+            'Content-Encoding' in response.headers:
+        return None
+    offered = ['br', 'gzip'] if brotli else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+
+def conditional(view):
+    """
+    decorator that gives a view's responses a strong etag and answers
+    matching If-None-Match requests with 304 Not Modified
+    """
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        if request.method not in ('GET', 'HEAD') or \
+                response.status_code != 200 or response.is_streamed:
+            return response
+        response.add_etag()
+        encoding = negotiate_encoding(response)
+        if encoding:
+            # each content coding is a different representation
+            etag, _ = response.get_etag()
+            response.set_etag('{}-{}'.format(etag, encoding))
+        return response.make_conditional(request)
+    return decorated
+
+
+def compress_response(response):
+    """
+    compresses a response body with brotli or gzip when the client
+    accepts it
+    """
+    if response.status_code != 200:
+        return response
+    encoding = negotiate_encoding(response)
+    if encoding is None:
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    started = time.perf_counter()
+    level = current_app.config['COMPRESS_LEVEL']
+    if encoding == 'br':
+        data = brotli.compress(data, quality=min(level, 11))
+    else:
+        data = gzip.compress(data, compresslevel=min(level, 9))
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    RESPONSE_COMPRESSED.send(None, duration=time.perf_counter() - started)
+    return response
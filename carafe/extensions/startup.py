@@ -0,0 +1,90 @@
+""" Carafe Startup Extension """
+
+import logging
+import time
+
+from flask import request_finished
+
+import carafe
+from carafe.database.base import render_markdown
+
+LOGGER = logging.getLogger(__name__)
+
+STARTUP_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# exercises the markdown extensions and the lexers of the languages forum
+# code is usually written in, without links so nothing is embedded
+WARM_UP_MARKDOWN = '\n\n'.join((
+    '# Warm up\n\nSome *emphasis*, **strong** text and `code`.',
+    '- one\n- two\n\n> quoted',
+    '| a | b |\n|---|---|\n| 1 | 2 |',
+    '```python\ndef warm(up):\n    return up\n```',
+    '```sql\nSELECT 1;\n```',
+    '```javascript\nvar warm = true;\n```',
+))
+
+
+class Startup:
+    """
+    warms up templates and the markdown pipeline before the first request
+    and reports how long importing, creating the application, warming up
+    and serving the first request took, as log lines and as the
+    carafe_startup_seconds histogram
+    """
+
+    def __init__(self):
+        self._app = None
+        self._pending = []
+        self._waiting = False
+
+    def init_app(self, app):
+        """
+        reports phases recorded before the application existed and waits
+        for its first request
+        """
+        self._app = app
+        self._waiting = True
+        request_finished.connect(self._finished, app)
+        pending, self._pending = self._pending, []
+        for phase, seconds in pending:
+            self.record(phase, seconds)
+
+    def imported(self):
+        """
+        records how long importing carafe took
+        """
+        self.record('import', time.perf_counter() - carafe.STARTED)
+
+    def record(self, phase, seconds):
+        """
+        reports how long a startup phase took
+        """
+        if self._app is None:
+            self._pending.append((phase, seconds))
+            return
+        LOGGER.info('startup: %s took %.0fms', phase, seconds * 1000)
+        metrics = self._app.extensions.get('carafe_metrics')
+        if metrics is not None:
+            metrics.observe(
+                'carafe_startup_seconds',
+                'Time taken by each startup phase of a worker.',
+                STARTUP_BUCKETS, seconds, phase=phase)
+
+    def warm_up(self):
+        """
+        compiles every template and builds the markdown pipeline so the
+        first requests do not pay for it; with a preloaded application the
+        work is done once before workers are forked
+        """
+        started = time.perf_counter()
+        env = self._app.jinja_env
+        for name in env.list_templates(extensions=('html',)):
+            env.get_template(name)
+        render_markdown(WARM_UP_MARKDOWN)
+        self.record('warm_up', time.perf_counter() - started)
+
+    def _finished(self, _sender, **_extra):
+        if not self._waiting:
+            return
+        self._waiting = False
+        self.record('first_request', time.perf_counter() - carafe.STARTED)
@@ -0,0 +1,190 @@
+""" Carafe Throttle Extension """
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+
+from carafe.extensions.cache import SqliteConnection
+
+
+def parse_rate(rate):
+    """
+    parses a rate written as REQUESTS/SECONDS into the bucket capacity and
+    the tokens it regains per second
+    """
+    requests, _, seconds = rate.partition('/')
+    return int(requests), int(requests) / float(seconds)
+
+
+class MemoryBuckets:
+    """
+    token buckets kept in this process, bounded by forgetting the buckets
+    that were used least recently
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        """
+        takes a token from a bucket, returning 0 when one was available and
+        otherwise the seconds until one will be
+        """
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            while len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SqliteBuckets:
+    """
+    token buckets stored in a local sqlite file so every worker process on
+    a host draws from the same buckets; each check is a primary key read
+    and write in one short transaction
+    """
+    # buckets that have refilled are only removed every so many writes
+    PRUNE_INTERVAL = 256
+
+    def __init__(self, path, table='throttle'):
+        self.path = path
+        self.table = table
+        self._writes = 0
+        self._db = SqliteConnection(path, (
+            'PRAGMA journal_mode=WAL',
+            'PRAGMA synchronous=OFF',
+            'CREATE TABLE IF NOT EXISTS {0} ('
+            'key TEXT PRIMARY KEY, tokens REAL, updated REAL, '
+            'full_at REAL)'.format(table)))
+
+    def take(self, key, capacity, rate):
+        """
+        takes a token from a bucket, returning 0 when one was available and
+        otherwise the seconds until one will be
+        """
+        with self._db as conn:
+            return self._take(conn, key, capacity, rate)
+
+    def _take(self, conn, key, capacity, rate):
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT tokens, updated FROM {} WHERE key = ?'.format(
+                    self.table), (key,)).fetchone()
+            tokens, updated = row or (capacity, now)
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            conn.execute(
+                'INSERT OR REPLACE INTO {} (key, tokens, updated, full_at) '
+                'VALUES (?, ?, ?, ?)'.format(self.table),
+                (key, tokens, now, now + (capacity - tokens) / rate))
+            self._writes += 1
+            if self._writes % self.PRUNE_INTERVAL == 0:
+                conn.execute('DELETE FROM {} WHERE full_at <= ?'.format(
+                    self.table), (now,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+
+class Throttle:
+    """
+    token bucket rate limits on write routes, applied separately to the
+    client address and the signed in user, so neither a single account nor
+    a single host can flood the database; buckets are never keyed on input
+    a client chooses, such as a login name, so nobody can drain another
+    account's budget
+    """
+
+    def __init__(self):
+        self.buckets = None
+        self.rates = {}
+        self.by_address = False
+        self._app = None
+
+    def init_app(self, app):
+        """
+        configures the bucket store and the rate of each rule; the
+        throttle stays disabled unless THROTTLE is memory or sqlite, and
+        client addresses are only throttled once PROXIES is configured,
+        since behind an unknown proxy every client shares its address
+        """
+        self._app = app
+        app.extensions['carafe_throttle'] = self
+        kind = app.config['THROTTLE']
+        if kind == 'memory':
+            self.buckets = MemoryBuckets()
+        elif kind == 'sqlite':
+            self.buckets = SqliteBuckets(app.config['THROTTLE_PATH'])
+        else:
+            self.buckets = None
+        self.rates = {
+            rule: parse_rate(rate)
+            for rule, rate in app.config['THROTTLE_RATES'].items()}
+        self.by_address = app.config['PROXIES'] is not None
+        if self.buckets is not None and not self.by_address:
+            app.logger.warning(
+                'CARAFE_PROXIES is not set, so only signed in users are '
+                'throttled; set it to the number of proxies in front of '
+                'carafe, or 0 if clients connect directly')
+
+    def _count(self, rule, scope, result):
+        metrics = self._app.extensions.get('carafe_metrics')
+        if metrics is not None:
+            metrics.inc(
+                'carafe_throttle_checks_total',
+                'Throttled route submissions by rule, scope and result.',
+                rule=rule, scope=scope, result=result)
+
+    def check(self, rule):
+        """
+        takes a token for the current request from each of its buckets,
+        raising TooManyRequests with the longest wait when any is empty
+        """
+        if self.buckets is None or rule not in self.rates:
+            return
+        capacity, rate = self.rates[rule]
+        scopes = [('ip', request.remote_addr)] if self.by_address else []
+        if current_user.is_authenticated:
+            scopes.append(('user', current_user.uid))
+        wait = 0
+        for scope, identity in scopes:
+            if identity in (None, ''):
+                continue
+            waited = self.buckets.take(
+                '{}:{}:{}'.format(rule, scope, identity), capacity, rate)
+            self._count(rule, scope, 'throttled' if waited else 'allowed')
+            wait = max(wait, waited)
+        if wait:
+            raise TooManyRequests(retry_after=int(math.ceil(wait)))
+
+    def limit(self, rule):
+        """
+        decorator that throttles the form submissions of a view under the
+        named rule
+        """
+        def decorator(view):
+            @wraps(view)
+            def decorated(*args, **kwargs):
+                if request.method == 'POST':
+                    self.check(rule)
+                return view(*args, **kwargs)
+            return decorated
+        return decorator
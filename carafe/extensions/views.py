@@ -0,0 +1,47 @@
+""" Carafe Views Extension """
+
+
+class Views:
+    """
+    collects routes and handlers declared at import time and registers
+    them on each application made by the factory; unlike a blueprint the
+    endpoints keep their bare names
+    """
+
+    def __init__(self):
+        self._deferred = []
+
+    def route(self, rule, **options):
+        """
+        decorator that routes a rule to a view named after the function
+        """
+        def register(view):
+            self._deferred.append(
+                lambda app: app.add_url_rule(
+                    rule, view.__name__, view, **options))
+            return view
+        return register
+
+    def errorhandler(self, code):
+        """
+        decorator that handles an error code or exception class
+        """
+        def register(handler):
+            self._deferred.append(
+                lambda app: app.register_error_handler(code, handler))
+            return handler
+        return register
+
+    def after_request(self, func):
+        """
+        decorator that runs a function on every response
+        """
+        self._deferred.append(lambda app: app.after_request(func))
+        return func
+
+    def init_app(self, app):
+        """
+        registers everything collected so far on an application
+        """
+        for deferred in self._deferred:
+            deferred(app)
@@ -0,0 +1,11 @@
+""" Carafe Signals """
+
+from flask.signals import Namespace
+
+CARAFE_SIGNALS = Namespace()
+
+# sent after user markdown is rendered with the time it took in seconds
+CONTENT_RENDERED = CARAFE_SIGNALS.signal('content-rendered')
+
+# sent after a response body is compressed with the time it took in seconds
+RESPONSE_COMPRESSED = CARAFE_SIGNALS.signal('response-compressed')
@@ -0,0 +1,16 @@
+/* Carafe edit forms: fetches an edit form the first time it is expanded */
+(function ($) {
+    $(document).on('show.bs.collapse', '[data-edit-form]', function () {
+        var $target = $(this);
+        if ($target.data('loaded')) {
+            return;
+        }
+        $target.data('loaded', true);
+        $.get($target.data('edit-form')).done(function (html) {
+            $target.html(html);
+        }).fail(function () {
+            // let the next expansion try again
+            $target.data('loaded', false);
+        });
+    });
+})(jQuery);
@@ -0,0 +1,23 @@
+/* Carafe live comments: applies comment changes streamed from the server */
+(function ($) {
+    var $comments = $('#comments');
+    var url = $comments.data('live');
+    if (!url || !window.EventSource) {
+        return;
+    }
+    var source = new EventSource(url);
+    source.addEventListener('comment', function (event) {
+        var message = JSON.parse(event.data);
+        var $existing = $('#comment-' + message.cid);
+        if ($existing.length) {
+            // keep the controls rendered for this reader, only the content
+            // is shared by everyone
+            $existing.find('.content').replaceWith(
+                $(message.html).find('.content'));
+        } else if (message.action === 'created' &&
+                   !$comments.find('[data-direction=newer]').length) {
+            // readers with newer pages left to load get it along with them
+            $comments.append(message.html);
+        }
+    });
+})(jQuery);
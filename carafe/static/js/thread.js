@@ -0,0 +1,24 @@
+/* Carafe threads: loads further pages of comments in place */
+(function ($) {
+    $('#comments').on('click', '.comment-pager a', function (event) {
+        var $link = $(this);
+        var $pager = $link.closest('.comment-pager');
+        if ($pager.hasClass('loading')) {
+            event.preventDefault();
+            return;
+        }
+        $pager.addClass('loading');
+        $.get($link.data('fragment')).done(function (html) {
+            // the fragment brings its own pager for the page after it, and
+            // may repeat comments that arrived live in the meantime
+            var $rows = $($.parseHTML(html)).filter(function () {
+                return !this.id || !document.getElementById(this.id);
+            });
+            $pager.replaceWith($rows);
+        }).fail(function () {
+            // fall back to navigating to the page
+            window.location = $link.attr('href');
+        });
+        event.preventDefault();
+    });
+})(jQuery);
@@ -0,0 +1,74 @@
+""" Carafe Tasks """
+
+import logging
+
+from flask import current_app
+from sqlalchemy.orm import undefer_group
+
+from carafe.database import archive as archival
+from carafe.database.base import OEMBED_PROVIDERS
+from carafe.database.model import Post, Comment, DB
+from carafe.extensions.jobs import JobQueue
+from carafe.extensions.pagecache import (
+    INDEX_SCOPE, board_scope, post_scope
+)
+
+LOGGER = logging.getLogger(__name__)
+
+JOBS = JobQueue()
+
+CONTENT = {'post': Post, 'comment': Comment}
+
+
+@JOBS.task('render')
+def render(kind, key):
+    """
+    renders the stored html of a post or comment, and a post's excerpt,
+    waiting on any embeds it links to
+    """
+    row = CONTENT[kind].query.options(undefer_group('rendered')).get(key)
+    if row is None or row.is_rendered:
+        return
+    with OEMBED_PROVIDERS.blocking():
+        row.render()
+    if kind == 'post':
+        JOBS.enqueue('bump', board_scope(row.bid), post_scope(row.pid))
+    else:
+        JOBS.enqueue('bump', post_scope(row.pid))
+    DB.session.commit()
+
+
+@JOBS.task('bump')
+def bump(*scopes):
+    """
+    invalidates the cached pages of the provided scopes
+    """
+    current_app.extensions['carafe_page_cache'].bump(*scopes)
+
+
+@JOBS.task('archive')
+def archive(days=None):
+    """
+    moves content deleted more than days, or ARCHIVE_AFTER_DAYS, ago into
+    the archive tables
+    """
+    counts = archival.archive_deleted(
+        current_app.config['ARCHIVE_AFTER_DAYS'] if days is None else days,
+        current_app.config['DELETE_BATCH'],
+        lambda kind, count: LOGGER.info('archived %d %s(s)', count, kind))
+    LOGGER.info('archived %d post(s) and %d comment(s)',
+                counts['post'], counts['comment'])
+
+
+@JOBS.task('erase_board')
+def erase_board(bid):
+    """
+    permanently removes a board and everything posted on it in batches
+    """
+    counts = archival.erase_board(
+        bid, current_app.config['DELETE_BATCH'],
+        lambda kind, count: LOGGER.info(
+            'erasing board %s: removed %d %s(s)', bid, count, kind))
+    LOGGER.info('erased board %s: %s', bid, ', '.join(
+        '{} {}(s)'.format(count, kind) for kind, count in counts.items()))
+    bump(INDEX_SCOPE, board_scope(bid))
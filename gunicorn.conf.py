@@ -0,0 +1,22 @@
+""" Carafe Gunicorn Configuration """
+from gevent import monkey
+
+# the application is created once in the master and forked into workers,
+# which needs gevent to patch the standard library before it is imported
+monkey.patch_all()
+
+preload_app = True
+
+# live comment streams stay open for as long as a reader keeps a post open,
+# gevent workers hold each one as a greenlet instead of a whole thread
+worker_class = 'gevent'
+worker_connections = 2000
+
+
+def post_fork(server, worker):
+    # pylint: disable=unused-argument
+    """
+    makes psycopg2 yield to other greenlets while it waits on postgres
+    """
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
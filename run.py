@@ -1,6 +1,8 @@
 """ Carafe - Flask Message Board """
 from os import environ
-from carafe.app import APP
+from carafe.app import create_app
+
+APP = create_app()
 
 if __name__ == '__main__':
     APP.run(